@@ -0,0 +1,305 @@
+'''
+Batch conversion of meas_data.Data text files to binary files.
+
+Walks a directory tree, reads all .dat files (also compressed .dat.gz,
+.dat.xz) by meas_reader.DataReader in a pool of worker processes (one per
+CPU by default) and writes for every file either a NumPy .npz file or an
+HDF5 .h5 file (needs h5py) to the same relative path in the output
+directory. Sha1 of the content of every converted file is kept in
+manifest.json in the output directory, files with unchanged content are
+skipped in the next run. Throughput (MB/s of the text files) is reported.
+
+npz file: array data_N (2D, rows*columns) for segment N, meta - json
+text with list of segments (date, sample, measurement, end_date,
+columns, settings, notes).
+h5 file: group segment_N for segment N with dataset data, header values
+as attributes and subgroup settings with settings as attributes.
+
+Usage (command line):
+
+python -m lab233.dat_convert D:\\data D:\\data_npz
+python -m lab233.dat_convert D:\\data D:\\data_h5 --format h5 --processes 4
+
+or from python:
+
+import lab233.dat_convert
+summary = lab233.dat_convert.convert_tree('D:\\\\data', 'D:\\\\data_npz')
+
+NOTE (Windows): convert_tree uses multiprocessing, call it from the
+    if __name__ == '__main__':
+block of the script.
+'''
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import multiprocessing
+import numpy as np
+
+from .meas_reader import DataReader
+from .meas_data import replace_file
+from .meas_data_bin import _json_default
+
+MANIFEST_FILE = 'manifest.json'
+FORMATS = {'npz': '.npz', 'h5': '.h5'}
+EXTENSIONS = ('.dat', '.dat.gz', '.dat.xz')
+
+_HEADER_KEYS = ('date', 'sample', 'measurement', 'end_date')
+
+
+def file_sha1(path, chunk_size=1<<20):
+    '''
+    Returns sha1 (hex) of the content of the file.
+    '''
+    sha1 = hashlib.sha1()
+    f = open(path, 'rb')
+    try:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha1.update(chunk)
+    finally:
+        f.close()
+    return sha1.hexdigest()
+
+
+def _segment_meta(seg):
+    meta = dict((k, seg[k]) for k in _HEADER_KEYS)
+    meta['columns'] = seg['columns']
+    meta['settings'] = seg['settings']
+    meta['notes'] = seg['notes']
+    return meta
+
+
+def _write_npz(out_file, reader):
+    arrays = {}
+    meta = []
+    for i, seg in enumerate(reader.segments):
+        arrays['data_%i' %i] = reader.load(i)
+        meta.append(_segment_meta(seg))
+    arrays['meta'] = np.array(json.dumps(meta, default=_json_default))
+    f = open(out_file, 'wb')
+    try:
+        np.savez(f, **arrays)
+    finally:
+        f.close()
+
+
+def _write_h5(out_file, reader):
+    import h5py
+    f = h5py.File(out_file, 'w')
+    try:
+        for i, seg in enumerate(reader.segments):
+            group = f.create_group('segment_%i' %i)
+            group.create_dataset('data', data=reader.load(i))
+            for k in _HEADER_KEYS:
+                if seg[k] is not None: group.attrs[k] = seg[k]
+            if seg['columns']:
+                group.attrs['columns'] = json.dumps(seg['columns'])
+            if seg['notes']:
+                group.attrs['notes'] = '\n'.join(seg['notes'])
+            settings = group.create_group('settings')
+            for k, v in seg['settings'].items():
+                try:
+                    settings.attrs[k] = v
+                except (TypeError, ValueError):
+                    settings.attrs[k] = json.dumps(v, default=_json_default)
+    finally:
+        f.close()
+
+
+_WRITERS = {'npz': _write_npz, 'h5': _write_h5}
+
+
+def output_file(path, root, out_root, fmt='npz'):
+    '''
+    Returns name of the output file of data file path from tree root.
+    '''
+    rel = os.path.relpath(path, root)
+    for ext in EXTENSIONS[::-1]:
+        if rel.endswith(ext):
+            rel = rel[:-len(ext)]
+            break
+    return os.path.join(out_root, rel + FORMATS[fmt])
+
+
+def convert_file(path, out_file, fmt='npz', known_sha1=None):
+    '''
+    Converts one data file to out_file. Nothing is written if sha1 of the
+    file is known_sha1 and out_file exists.
+    Returns (sha1, converted).
+    '''
+    sha1 = file_sha1(path)
+    if sha1 == known_sha1 and os.path.exists(out_file):
+        return sha1, False
+
+    out_dir = os.path.dirname(out_file)
+    if out_dir and not os.path.exists(out_dir):
+        try:
+            os.makedirs(out_dir)
+        except OSError:
+            if not os.path.isdir(out_dir): raise   # created by other worker
+
+    #written to temporary file, the output is never half written
+    tmp_file = out_file + '.tmp'
+    reader = DataReader(path)
+    try:
+        _WRITERS[fmt](tmp_file, reader)
+    except:
+        if os.path.exists(tmp_file): os.remove(tmp_file)
+        raise
+    finally:
+        reader.close()
+    replace_file(tmp_file, out_file)
+    return sha1, True
+
+
+def _convert_safe(args):
+    path, out_file, fmt, known_sha1 = args
+    try:
+        sha1, converted = convert_file(path, out_file, fmt, known_sha1)
+        return path, sha1, converted, None
+    except Exception as e:
+        return path, None, False, '%s: %s' %(type(e).__name__, e)
+
+
+def load_manifest(out_root):
+    '''
+    Returns dictionary {relative path: {sha1, mtime, size, format}} of
+    files converted to out_root.
+    '''
+    name = os.path.join(out_root, MANIFEST_FILE)
+    if not os.path.exists(name):
+        return {}
+    f = open(name)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+def _save_manifest(out_root, manifest):
+    name = os.path.join(out_root, MANIFEST_FILE)
+    f = open(name + '.tmp', 'w')
+    json.dump(manifest, f, indent=1, sort_keys=True)
+    f.close()
+    replace_file(name + '.tmp', name)
+
+
+def convert_tree(root, out_root, fmt='npz', processes=None,
+                 extension=EXTENSIONS, verbose=False):
+    '''
+    Converts all files with extension in directory tree root to fmt
+    ('npz' or 'h5') files in out_root, in processes worker processes
+    (default number of CPUs). Files with the same mtime and size as
+    in the last run are skipped without reading, files with changed
+    mtime are read and skipped if their sha1 did not change.
+    Returns dictionary with numbers of converted, skipped and failed
+    files, megabytes of the converted files, time [s], throughput [MB/s]
+    and list of errors (path, message).
+    '''
+    if not fmt in FORMATS:
+        raise RuntimeError('Unknown format %s, use one of %s' %(fmt, sorted(FORMATS)))
+    if fmt == 'h5':
+        try:
+            import h5py
+        except ImportError:
+            raise RuntimeError('Format h5 needs h5py package')
+    t0 = time.time()
+    if not os.path.exists(out_root):
+        os.makedirs(out_root)
+    manifest = load_manifest(out_root)
+    out_abs = os.path.abspath(out_root)
+
+    tasks = []
+    stats = {}
+    skipped = 0
+    for dir_path, dir_names, file_names in os.walk(root):
+        if os.path.abspath(dir_path) == out_abs:
+            dir_names[:] = []       # output inside of the tree
+            continue
+        for name in file_names:
+            if not name.endswith(extension):
+                continue
+            path = os.path.join(dir_path, name)
+            rel = os.path.relpath(path, root)
+            out_file = output_file(path, root, out_root, fmt)
+            st = os.stat(path)
+            known = manifest.get(rel)
+            if (known and known['format'] == fmt and
+                    (known['mtime'], known['size']) == (st.st_mtime, st.st_size) and
+                    os.path.exists(out_file)):
+                skipped += 1
+                continue
+            stats[path] = (rel, st)
+            tasks.append((path, out_file, fmt,
+                          known['sha1'] if known and known['format'] == fmt else None))
+
+    #largest files first, the workers finish at about the same time
+    tasks.sort(key=lambda t: -stats[t[0]][1].st_size)
+
+    converted = 0
+    megabytes = 0.0
+    errors = []
+    if tasks:
+        pool = multiprocessing.Pool(processes)
+        try:
+            for path, sha1, done, error in pool.imap_unordered(
+                    _convert_safe, tasks, chunksize=1):
+                rel, st = stats[path]
+                megabytes += st.st_size/1e6
+                if error is not None:
+                    errors.append((path, error))
+                    if verbose: print('FAILED %s: %s' %(rel, error))
+                    continue
+                manifest[rel] = {'sha1': sha1, 'mtime': st.st_mtime,
+                                 'size': st.st_size, 'format': fmt}
+                if done:
+                    converted += 1
+                else:
+                    skipped += 1
+                if verbose: print('%s %s' %('converted' if done else 'unchanged', rel))
+        finally:
+            pool.close()
+            pool.join()
+            _save_manifest(out_root, manifest)
+
+    elapsed = time.time() - t0
+    return {
+        'converted': converted,
+        'skipped': skipped,
+        'failed': len(errors),
+        'megabytes': megabytes,
+        'time': elapsed,
+        'throughput': megabytes/elapsed if elapsed > 0 else 0.0,
+        'errors': errors,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Converts meas_data text files in a directory tree '
+                    'to NumPy (.npz) or HDF5 (.h5) files.')
+    parser.add_argument('root', help='directory with the data files')
+    parser.add_argument('out_root', help='output directory')
+    parser.add_argument('--format', default='npz', choices=sorted(FORMATS))
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args(argv)
+
+    summary = convert_tree(args.root, args.out_root, args.format,
+                           args.processes, verbose=args.verbose)
+    for path, error in summary['errors']:
+        sys.stderr.write('%s: %s\n' %(path, error))
+    print('%i converted, %i unchanged, %i failed, %.1f MB in %.1f s (%.1f MB/s)' %(
+        summary['converted'], summary['skipped'], summary['failed'],
+        summary['megabytes'], summary['time'], summary['throughput']))
+    return 1 if summary['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
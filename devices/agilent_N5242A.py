@@ -70,22 +70,29 @@ class Agilent_N5242A(Instrument):
 ##        amp,phase = amp_phase.split(',')
 ##        return float(amp), float(phase)
 
-    def prelocate(self, peak, region, span, meas=1):
-        from ..peak_lorentz_fit import find_fit_region, fit_lorentz
+    def prelocate(self, peak, region, span, meas=1, estimate=False):
+        '''
+        estimate=True - fit is started from peak_lorentz_fit.estimate_lorentz
+        of the measured trace instead of marker search of the analyzer
+        (no queries except of the trace)
+        '''
+        from ..peak_lorentz_fit import find_fit_region, fit_lorentz, estimate_lorentz
         
         amp, phs = self.run_transM_meas(meas=meas)
-        peak_params = self.get_peak_params(meas=meas)
-
         f = np.linspace(peak[2], peak[3], peak[4])
-        fit_params0 = [
-            10**(peak_params[3]/10.),
-            peak_params[0],
-            peak_params[1],
-            10**(-10)
-            ]      #[loss(lin.), half-bandwidth, center_freq, offs(lin.)]        
+        if estimate:
+            fit_params0 = estimate_lorentz(f, 10**(amp/10.))
+        else:
+            peak_params = self.get_peak_params(meas=meas)
+            fit_params0 = [
+                10**(peak_params[3]/10.),
+                peak_params[0],
+                peak_params[1],
+                10**(-10)
+                ]      #[loss(lin.), half-bandwidth, center_freq, offs(lin.)]        
 
         startp, stopp = find_fit_region(
-            peak[2], peak[3], peak[4], peak_params[1], region)#fiting region
+            peak[2], peak[3], peak[4], fit_params0[2], region)#fiting region
         
         fit_params, chi = fit_lorentz(
             f[startp:stopp],
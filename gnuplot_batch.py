@@ -0,0 +1,155 @@
+'''
+Rendering of many PyGnuplot figures to PNG files without windows.
+
+Each figure is given by the keyword arguments of pyGnuplot.PyGnuplot
+(plotfile_name, number_of_rows, number_of_columns, title, plots and
+optionally file_path, size). Figures are rendered by a pool of gnuplot
+processes (pngcairo terminal), every process renders many figures, it is
+started only once for the whole batch. The .gnu script of every figure
+is written as by PyGnuplot, the figure is saved to
+file_path/plotfile_name.png.
+
+Usage:
+
+import lab233.gnuplot_batch
+specs = [dict(plotfile_name='res%i' %i, number_of_rows=1,
+              number_of_columns=1, title='resonance %i' %i,
+              plots=(('res%i.dat' %i, 1, 2, 'f [Hz]', 'S21', '', 'line'),))
+         for i in range(100)]
+results, summary = lab233.gnuplot_batch.render_batch(specs, processes=4)
+print(summary['figures_per_second'])
+
+Command line (specs - json file with list of the dictionaries):
+
+python -m lab233.gnuplot_batch specs.json --processes 4
+'''
+import sys
+import json
+import time
+import argparse
+import threading
+import multiprocessing
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from .pyGnuplot import PyGnuplot, _GnuplotProcess, GNUPLOT
+
+
+def _render_job(gp, spec, term):
+    '''
+    Renders one figure by running gnuplot process gp. Returns dictionary
+    with png file name, gnuplot messages and rendering time.
+    '''
+    t0 = time.time()
+    plot = PyGnuplot(savefig=False, **spec)
+    #state of the previous figure is removed
+    gp.send(['unset multiplot', 'reset'] +
+            plot._png_lines(term=term))
+    messages = gp.sync()
+    return {
+        'png': plot.png_file(),
+        'messages': messages,
+        'time': time.time() - t0,
+        }
+
+
+def _worker(jobs, results, gnuplot, term):
+    gp = None
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        i, spec = job
+        try:
+            if gp is None:
+                gp = _GnuplotProcess(gnuplot, capture=True)
+            results[i] = _render_job(gp, spec, term)
+        except Exception as e:
+            results[i] = {'png': None, 'messages': ['%s: %s' %(type(e).__name__, e)],
+                          'time': 0.0}
+            if gp is not None and gp.process.poll() is not None:
+                gp = None           # gnuplot died, new one for next job
+    if gp is not None:
+        gp.close()
+
+
+def render_batch(specs, processes=None, gnuplot=GNUPLOT, term='pngcairo'):
+    '''
+    Renders figures of the list of specs (dictionaries with arguments of
+    PyGnuplot) in processes gnuplot processes (default number of CPUs).
+    Returns (results, summary). results - list of dictionaries (png file
+    name or None if failed, list of gnuplot messages, time [s]) in order
+    of specs; summary - dictionary with number of figures, number of
+    figures with messages (errors or warnings of gnuplot), total time [s]
+    and figures per second.
+    '''
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(specs)))
+    t0 = time.time()
+    jobs = queue.Queue()
+    for job in enumerate(specs):
+        jobs.put(job)
+    results = [None]*len(specs)
+    workers = []
+    for n in range(processes):
+        jobs.put(None)
+        w = threading.Thread(target=_worker, args=(jobs, results, gnuplot, term))
+        w.daemon = True
+        w.start()
+        workers.append(w)
+    for w in workers:
+        w.join()
+
+    elapsed = time.time() - t0
+    summary = {
+        'figures': len(specs),
+        'with_messages': len([r for r in results if r['messages']]),
+        'time': elapsed,
+        'figures_per_second': len(specs)/elapsed if elapsed > 0 else 0.0,
+        }
+    return results, summary
+
+
+def _to_str(obj):
+    '''
+    Converts unicode strings from json to str (python 2), PyGnuplot
+    checks markers by type str.
+    '''
+    if isinstance(obj, dict):
+        return dict((str(k), _to_str(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return [_to_str(v) for v in obj]
+    if sys.version_info[0] < 3 and isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    return obj
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Renders PyGnuplot figures to PNG files.')
+    parser.add_argument('specs', help='json file with list of PyGnuplot arguments')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of gnuplot processes (default: number of CPUs)')
+    parser.add_argument('--gnuplot', default=GNUPLOT, help='gnuplot executable')
+    parser.add_argument('--term', default='pngcairo', help='gnuplot terminal')
+    args = parser.parse_args(argv)
+
+    f = open(args.specs)
+    specs = _to_str(json.load(f))
+    f.close()
+    results, summary = render_batch(specs, args.processes, args.gnuplot, args.term)
+    for spec, result in zip(specs, results):
+        for message in result['messages']:
+            sys.stderr.write('%s: %s\n' %(spec['plotfile_name'], message))
+    print('%i figures in %.1f s (%.1f figures/s), %i with messages' %(
+        summary['figures'], summary['time'], summary['figures_per_second'],
+        summary['with_messages']))
+    return 1 if [r for r in results if r['png'] is None] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
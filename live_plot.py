@@ -0,0 +1,204 @@
+'''
+Live plotting of arrays by matplotlib, alternative to pyGnuplot.
+
+LivePlot takes the same layout arguments as pyGnuplot.PyGnuplot (number
+of rows and columns of graphs, title, plots tuples - data file names and
+columns are not used) and plots arrays passed from the measurement loop
+by update(). Only the lines are redrawn (blitting), axes with labels and
+ticks are drawn again only when the data exceed the current limits.
+
+Usage:
+
+import lab233.live_plot
+plots = (('', 1, 2, 'f [Hz]', 'amplitude', 'S21', 'line'),
+         ('', [1, 1], [2, 3], 'f [Hz]', 'phase', 'phase', ['point', 'line']))
+plot = lab233.live_plot.LivePlot(1, 2, 'VNA', plots)
+plot.show()
+while measuring:
+    plot.update([(f, amp), (f, [phase, phase_fit])])
+plot.savefig('vna.png')
+print(plot.stats())
+'''
+import time
+import numpy as np
+import matplotlib.pyplot as plt
+
+from .pyGnuplot import minmax_decimate, _plot_lines
+
+_MARKERS = {
+    'line': dict(linestyle='-', linewidth=2, marker=None),
+    'point': dict(linestyle='None', marker='o', markersize=4),
+    }
+
+
+class LivePlot(object):
+    def __init__(self, number_of_rows, number_of_columns, title, plots,
+                 size=(640, 480), dpi=100, margin=0.05, decimate=True):
+        '''
+        number_of_rows, number_of_columns, title, plots - as in PyGnuplot
+        size - size of the figure in pixels
+        margin - relative space added to the data range when the limits
+        of the axes are changed
+        decimate - number of buckets of min/max decimation of the lines
+        (True - width of the figure in pixels, None - no decimation), see
+        pyGnuplot.minmax_decimate. Lines of 10^5 points are drawn ~20 times
+        slower without decimation.
+        '''
+        if not len(plots) == number_of_rows*number_of_columns:
+            raise RuntimeError(
+                """number of plots is not equal to number """
+                """of rows times number of columns"""
+                )
+        self.plots = plots
+        self.margin = margin
+        if decimate is True: decimate = size[0]
+        self.decimate = decimate
+
+        self.fig, axes = plt.subplots(
+            number_of_rows, number_of_columns, squeeze=False,
+            figsize=(size[0]/float(dpi), size[1]/float(dpi)), dpi=dpi)
+        self.fig.suptitle(title)
+        self.axes = list(axes.flat)
+        self.lines = []         # list of lines of each axes
+        for ax, plot in zip(self.axes, plots):
+            ax.set_xlabel(plot[3])
+            ax.set_ylabel(plot[4])
+            ax.set_title(plot[5])
+            number_of_lines = len(plot[2]) if hasattr(plot[2], '__iter__') else 1
+            markers = plot[6]
+            if isinstance(markers, str): markers = [markers]
+            markers = list(markers) + [markers[0]]*(number_of_lines - len(markers))
+            lines = []
+            for marker in markers[:number_of_lines]:
+                if not marker.lower() in _MARKERS:
+                    raise RuntimeError('Invalid option. Either "line" or "point" can be used.')
+                line, = ax.plot([], [], animated=True, **_MARKERS[marker.lower()])
+                lines.append(line)
+            self.lines.append(lines)
+        self.fig.tight_layout(rect=(0, 0, 1, 0.95))
+
+        self.canvas = self.fig.canvas
+        self._backgrounds = None
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+
+        self.frames = 0
+        self.full_redraws = 0
+        self._t0 = None
+
+    def __repr__(self):
+        return '<LivePlot %i graphs>' %len(self.axes)
+
+    def show(self):
+        '''
+        Opens the window of the figure (does not block).
+        '''
+        plt.show(block=False)
+        plt.pause(0.001)
+
+    def _on_draw(self, event):
+        '''
+        Full redraw (new limits, resize of the window): backgrounds without
+        lines are stored for blitting and lines are drawn on them.
+        '''
+        self._backgrounds = [self.canvas.copy_from_bbox(ax.bbox) for ax in self.axes]
+        for ax, lines in zip(self.axes, self.lines):
+            for line in lines:
+                ax.draw_artist(line)
+
+    def _set_limits(self, ax, x_range, y_range):
+        '''
+        Extends limits of the axes if the data exceed them. Returns True
+        if the limits changed.
+        '''
+        changed = False
+        for (lo, hi), get, set_ in ((x_range, ax.get_xlim, ax.set_xlim),
+                                    (y_range, ax.get_ylim, ax.set_ylim)):
+            if not (np.isfinite(lo) and np.isfinite(hi)):
+                continue
+            old_lo, old_hi = get()
+            if self.frames and old_lo <= lo and hi <= old_hi:
+                continue
+            space = (hi - lo)*self.margin or abs(hi)*self.margin or 1.0
+            set_(lo - space, hi + space)
+            changed = True
+        return changed
+
+    def update(self, data):
+        '''
+        Plots arrays, data has the same form as in PyGnuplot.plot_arrays:
+        one item (x, y) for each plot, y is an array or a list of arrays
+        (one for each line of the plot), x is an array or a list of arrays.
+        '''
+        if not len(data) == len(self.plots):
+            raise RuntimeError('data has to contain one item for each plot')
+        if self._t0 is None: self._t0 = time.time()
+        full = self._backgrounds is None
+        for ax, lines, (x, y) in zip(self.axes, self.lines, data):
+            x, y = _plot_lines(x, y)
+            x_lo = y_lo = np.inf
+            x_hi = y_hi = -np.inf
+            for line, x_data, y_data in zip(lines, x, y):
+                x_data = np.asarray(x_data, dtype=float)
+                y_data = np.asarray(y_data, dtype=float)
+                if self.decimate and len(y_data) > 2*self.decimate:
+                    x_data, y_data = self._decimated(x_data, y_data)
+                line.set_data(x_data, y_data)
+                if len(x_data):
+                    x_lo = min(x_lo, np.nanmin(x_data))
+                    x_hi = max(x_hi, np.nanmax(x_data))
+                    y_lo = min(y_lo, np.nanmin(y_data))
+                    y_hi = max(y_hi, np.nanmax(y_data))
+            if self._set_limits(ax, (x_lo, x_hi), (y_lo, y_hi)):
+                full = True
+
+        if full:
+            self.canvas.draw()          # _on_draw stores the backgrounds
+            self.canvas.blit(self.fig.bbox)
+            self.full_redraws += 1
+        else:
+            for ax, lines, background in zip(self.axes, self.lines, self._backgrounds):
+                self.canvas.restore_region(background)
+                for line in lines:
+                    ax.draw_artist(line)
+                self.canvas.blit(ax.bbox)
+        self.canvas.flush_events()
+        self.frames += 1
+
+    def _decimated(self, x, y):
+        '''
+        Min/max decimation of one line to about 2*decimate points.
+        '''
+        bucket_rows = len(y)//self.decimate
+        mins, maxs = minmax_decimate(x[:,None], y[:,None], bucket_rows)
+        points = np.concatenate((mins[:,0], maxs[:,0]))
+        rest = len(mins)*bucket_rows
+        points = points[np.argsort(points[:,0], kind='mergesort')]
+        return (np.concatenate((points[:,1], x[rest:])),
+                np.concatenate((points[:,2], y[rest:])))
+
+    def savefig(self, file_name, **kwargs):
+        '''
+        Saves the figure with the current data (kwargs of Figure.savefig).
+        '''
+        lines = [line for lines in self.lines for line in lines]
+        for line in lines: line.set_animated(False)
+        try:
+            self.fig.savefig(file_name, **kwargs)
+        finally:
+            for line in lines: line.set_animated(True)
+            self._backgrounds = None     # full redraw by next update
+
+    def stats(self):
+        '''
+        Returns dictionary with number of frames, number of full redraws
+        and mean frame rate [1/s] since the first update.
+        '''
+        elapsed = time.time() - self._t0 if self._t0 is not None else 0.0
+        return {
+            'frames': self.frames,
+            'full_redraws': self.full_redraws,
+            'fps': self.frames/elapsed if elapsed > 0 else 0.0,
+            }
+
+    def close(self):
+        plt.close(self.fig)
@@ -0,0 +1,339 @@
+'''
+SQLite catalog of measurement data files.
+
+The catalog holds for every file written by meas_data.Data and for every
+measurement in it (fill_header ... fill_footer) the sample, measurement
+type, start and end time and settings (write_settings). Files are added
+when Data is created with catalog argument, existing files are indexed
+by Catalog.index_tree. Queries do not open the data files.
+
+Usage:
+
+import lab233.meas_data, lab233.meas_catalog
+data = lab233.meas_data.Data('new_data','0.0',catalog='D:\\\\data\\\\catalog.db')
+...
+
+cat = lab233.meas_catalog.Catalog('D:\\\\data\\\\catalog.db')
+cat.index_tree('D:\\\\data')            # backfill of existing files
+for run in cat.query(sample='MoC%', start_after='2015-03-01',
+                     start_before='2015-04-01',
+                     settings={'temperature': (0.29, 0.31)}):
+    print(run['path'], run['segment'], run['measurement'])
+cat.close()
+
+NOTE (Windows): index_tree uses multiprocessing, call it from the
+    if __name__ == '__main__':
+block of the script.
+'''
+import os
+import time
+import sqlite3
+import multiprocessing
+
+from .meas_reader import DataReader
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    size INTEGER
+    );
+CREATE TABLE IF NOT EXISTS runs (
+    path TEXT,
+    segment INTEGER,
+    sample TEXT,
+    measurement TEXT,
+    start REAL,
+    end REAL,
+    PRIMARY KEY (path, segment)
+    );
+CREATE TABLE IF NOT EXISTS settings (
+    path TEXT,
+    segment INTEGER,
+    key TEXT,
+    value TEXT,
+    num REAL,
+    PRIMARY KEY (path, segment, key)
+    );
+CREATE INDEX IF NOT EXISTS runs_sample ON runs (sample);
+CREATE INDEX IF NOT EXISTS runs_start ON runs (start);
+CREATE INDEX IF NOT EXISTS settings_key ON settings (key, num);
+'''
+
+_TIME_FORMATS = ('%a %b %d %H:%M:%S %Y', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+
+def to_epoch(t):
+    '''
+    Converts time (number of seconds, time.ctime() string or
+    'YYYY-MM-DD[ HH:MM[:SS]]' string) to number of seconds since epoch.
+    '''
+    if t is None or isinstance(t, (int, float)):
+        return t
+    for fmt in _TIME_FORMATS:
+        try:
+            return time.mktime(time.strptime(t.strip(), fmt))
+        except ValueError:
+            pass
+    raise RuntimeError('Unknown time format: %s' %t)
+
+
+def _setting_value(v):
+    '''
+    Returns (text, number) stored in the catalog for the setting value.
+    Arrays are stored as text "[first, last, length]".
+    '''
+    if hasattr(v, '__iter__') and not isinstance(v, str):
+        if len(v):
+            return '[%s, %s, %i]' %(v[0], v[-1], len(v)), None
+        return '[]', None
+    try:
+        return str(v), float(v)
+    except (TypeError, ValueError):
+        return str(v), None
+
+
+def scan_file(path):
+    '''
+    Reads header, settings and footer of all measurements in the file.
+    Returns (path, mtime, size, runs), runs is a list of dictionaries
+    (sample, measurement, start, end, settings). Only measurements
+    with #DATE line are listed.
+    '''
+    st = os.stat(path)
+    runs = []
+    reader = DataReader(path)
+    try:
+        for seg in reader.segments:
+            if seg['date'] is None:
+                continue
+            runs.append({
+                'sample': seg['sample'],
+                'measurement': seg['measurement'],
+                'start': to_epoch(seg['date']),
+                'end': to_epoch(seg['end_date']),
+                'settings': seg['settings'],
+                })
+    finally:
+        reader.close()
+    return path, st.st_mtime, st.st_size, runs
+
+
+def _scan_file_safe(path):
+    try:
+        return scan_file(path)
+    except Exception as e:
+        return path, None, None, e
+
+
+class Catalog(object):
+    def __init__(self, db_file):
+        '''
+        Opens (creates) the catalog in SQLite file db_file.
+        '''
+        self.db_file = db_file
+        self.db = sqlite3.connect(db_file, timeout=30.0)
+        self.db.executescript(_SCHEMA)
+        self.db.commit()
+
+    def __repr__(self):
+        return '<Catalog %s>' %self.db_file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    # --- recording of files written by meas_data.Data ---
+
+    def add_file(self, path):
+        path = os.path.abspath(path)
+        self.db.execute(
+            'INSERT OR REPLACE INTO files (path, mtime, size) VALUES (?, NULL, NULL)',
+            (path,))
+        self.db.commit()
+
+    def add_run(self, path, segment, sample, measurement, start):
+        self.db.execute(
+            'INSERT OR REPLACE INTO runs (path, segment, sample, measurement, start, end) '
+            'VALUES (?, ?, ?, ?, ?, NULL)',
+            (os.path.abspath(path), segment, str(sample), str(measurement), to_epoch(start)))
+        self.db.commit()
+
+    def end_run(self, path, segment, end):
+        self.db.execute(
+            'UPDATE runs SET end = ? WHERE path = ? AND segment = ?',
+            (to_epoch(end), os.path.abspath(path), segment))
+        self.db.commit()
+
+    def add_settings(self, path, segment, dict_of_variables, commit=True):
+        path = os.path.abspath(path)
+        rows = []
+        for k, v in dict_of_variables.items():
+            text, num = _setting_value(v)
+            rows.append((path, segment, str(k), text, num))
+        self.db.executemany(
+            'INSERT OR REPLACE INTO settings (path, segment, key, value, num) '
+            'VALUES (?, ?, ?, ?, ?)', rows)
+        if commit: self.db.commit()
+
+    # --- indexing of existing files ---
+
+    def _store_scan(self, path, mtime, size, runs):
+        path = os.path.abspath(path)
+        self.db.execute('DELETE FROM runs WHERE path = ?', (path,))
+        self.db.execute('DELETE FROM settings WHERE path = ?', (path,))
+        for i, run in enumerate(runs):
+            self.db.execute(
+                'INSERT INTO runs (path, segment, sample, measurement, start, end) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (path, i, run['sample'], run['measurement'], run['start'], run['end']))
+            self.add_settings(path, i, run['settings'], commit=False)
+        self.db.execute(
+            'INSERT OR REPLACE INTO files (path, mtime, size) VALUES (?, ?, ?)',
+            (path, mtime, size))
+
+    def index_file(self, path):
+        '''
+        Adds (or updates) one existing file.
+        '''
+        self._store_scan(*scan_file(path))
+        self.db.commit()
+
+    def index_tree(self, root, processes=None,
+                   extension=('.dat', '.dat.gz', '.dat.xz')):
+        '''
+        Adds all files with extension (string or tuple of strings) in
+        directory tree root. Files are
+        read in processes worker processes (default number of CPUs).
+        Files which did not change (same mtime and size) since they were
+        indexed are skipped. Returns (number of indexed files, list of
+        (path, exception) of files which could not be read).
+        '''
+        known = dict(
+            (path, (mtime, size)) for path, mtime, size in
+            self.db.execute('SELECT path, mtime, size FROM files'))
+
+        paths = []
+        for dir_path, dir_names, file_names in os.walk(root):
+            for name in file_names:
+                if not name.endswith(extension):
+                    continue
+                path = os.path.abspath(os.path.join(dir_path, name))
+                st = os.stat(path)
+                if known.get(path) == (st.st_mtime, st.st_size):
+                    continue
+                paths.append(path)
+
+        errors = []
+        indexed = 0
+        if paths:
+            pool = multiprocessing.Pool(processes)
+            try:
+                for path, mtime, size, runs in pool.imap_unordered(
+                        _scan_file_safe, paths, chunksize=16):
+                    if mtime is None:
+                        errors.append((path, runs))
+                        continue
+                    self._store_scan(path, mtime, size, runs)
+                    indexed += 1
+            finally:
+                pool.close()
+                pool.join()
+            self.db.commit()
+        return indexed, errors
+
+    def remove_missing(self):
+        '''
+        Removes files which do not exist any more from the catalog.
+        '''
+        missing = [(p,) for (p,) in self.db.execute('SELECT path FROM files')
+                   if not os.path.exists(p)]
+        for table in ('files', 'runs', 'settings'):
+            self.db.executemany('DELETE FROM %s WHERE path = ?' %table, missing)
+        self.db.commit()
+        return len(missing)
+
+    # --- queries ---
+
+    def query(self, sample=None, measurement=None, start_after=None,
+              start_before=None, settings=None, path=None):
+        '''
+        Returns list of measurements (dictionaries with keys path, segment,
+        sample, measurement, start, end - times in seconds since epoch)
+        which match all given conditions:
+
+        sample, measurement, path - SQL LIKE patterns ('MoC%', '%_Q_%')
+        start_after, start_before - time (see to_epoch)
+        settings - dictionary {key: value}, value is either a value
+        (compared as number if possible, otherwise as text) or tuple
+        (min, max) of numbers (None for open end)
+        '''
+        where = []
+        args = []
+        for column, pattern in (('r.sample', sample),
+                                ('r.measurement', measurement),
+                                ('r.path', path)):
+            if pattern is not None:
+                where.append('%s LIKE ?' %column)
+                args.append(pattern)
+        if start_after is not None:
+            where.append('r.start >= ?')
+            args.append(to_epoch(start_after))
+        if start_before is not None:
+            where.append('r.start < ?')
+            args.append(to_epoch(start_before))
+
+        for key, value in (settings or {}).items():
+            cond = 's.key = ?'
+            s_args = [key]
+            if isinstance(value, tuple):
+                if value[0] is not None:
+                    cond += ' AND s.num >= ?'
+                    s_args.append(value[0])
+                if value[1] is not None:
+                    cond += ' AND s.num <= ?'
+                    s_args.append(value[1])
+            else:
+                text, num = _setting_value(value)
+                if num is None:
+                    cond += ' AND s.value = ?'
+                    s_args.append(text)
+                else:
+                    cond += ' AND s.num = ?'
+                    s_args.append(num)
+            where.append(
+                'EXISTS (SELECT 1 FROM settings s WHERE s.path = r.path '
+                'AND s.segment = r.segment AND %s)' %cond)
+            args.extend(s_args)
+
+        sql = 'SELECT r.path, r.segment, r.sample, r.measurement, r.start, r.end FROM runs r'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY r.start, r.path, r.segment'
+
+        keys = ('path', 'segment', 'sample', 'measurement', 'start', 'end')
+        return [dict(zip(keys, row)) for row in self.db.execute(sql, args)]
+
+    def files(self, **conditions):
+        '''
+        Returns list of paths of files with measurements matching the
+        conditions of query().
+        '''
+        paths = []
+        for run in self.query(**conditions):
+            if not run['path'] in paths:
+                paths.append(run['path'])
+        return paths
+
+    def settings(self, path, segment=0):
+        '''
+        Returns settings of the measurement as dictionary {key: text}.
+        '''
+        return dict(self.db.execute(
+            'SELECT key, value FROM settings WHERE path = ? AND segment = ?',
+            (os.path.abspath(path), segment)))
@@ -13,16 +13,228 @@ data.fill_header('MoC',RT'')
 data.write_settings(sett)
 data.write_data([1,2,3,4,[0.5,0.6,0.7,0.8]])
 data.fill_footer()
+
+Buffered mode keeps the file open between calls (flushed every
+flush_rows rows, every flush_interval seconds or by flush()):
+
+with lab233.meas_data.Data('new_data','0.0',buffered=True,flush_rows=100) as data:
+    data.fill_header('MoC','RT')
+    data.write_data(1,2,3)
+    data.fill_footer()
+...
+
+AsyncData has the same interface, but the file is written by a separate
+thread, so a slow disk does not stall the measurement loop:
+
+data = lab233.meas_data.AsyncData('new_data','0.0',queue_size=1000)
+...
+data.fill_footer()          # waits until everything is written
+data.close()
+print(data.stats())
 ...
 Matus Rehak
 Last update: 10.12.2015
 '''
 import time
 import os
+import errno
+import zlib
+import threading
 from string import digits
+import numpy as np
+try:
+    import Queue as queue       # python 2
+except ImportError:
+    import queue
+
+from .meas_reader import array_sha1
+
+
+def _to_list(values):
+    '''
+    Returns list of the values formatted by '%s' to the same text as
+    str() of the items. Arrays are converted to python numbers (fast),
+    except floats other than float64 (str(np.float32(0.1)) is '0.1',
+    str of the python float is '0.10000000149011612').
+    '''
+    if not hasattr(values, 'tolist'):
+        return list(values)
+    if values.dtype.kind in 'fc' and not values.dtype in (np.float64, np.complex128):
+        return list(values)
+    return values.tolist()
+
+
+def _parse_columns(columns):
+    '''
+    Converts list of column tuples (name, dtype, unit, fmt) to list
+    of dictionaries with default values filled in.
+    '''
+    if columns is None:
+        return None
+    parsed = []
+    for c in columns:
+        if isinstance(c, str): c = (c,)
+        name = c[0]
+        dtype = np.dtype(c[1] if len(c) > 1 else 'f8')
+        unit = c[2] if len(c) > 2 else ''
+        if len(c) > 3:
+            fmt = c[3]
+        else:
+            fmt = '%d' if dtype.kind in 'iub' else '%s'
+        for ch in '\t []:':
+            if ch in name or (ch in unit and not ch == ' '):
+                raise RuntimeError('Invalid column name %s[%s]' %(name, unit))
+        parsed.append({'name': name, 'dtype': dtype.str, 'unit': unit, 'fmt': fmt})
+    return parsed
+
+_COMPRESSED_EXTENSIONS = {'gzip': '.dat.gz', 'lzma': '.dat.xz'}
+
+class _FrameWriter(object):
+    '''
+    File-like object of the compressed mode of Data. Text is collected
+    in memory, flush() appends it to the file as one complete gzip member
+    (xz stream). Concatenated members are a valid gzip (xz) file.
+    '''
+    def __init__(self, file_name, compress):
+        if compress == 'lzma':
+            try:
+                import lzma
+            except ImportError:
+                raise RuntimeError('lzma compression needs python 3.3 or newer')
+            self._compressor = lambda: lzma.LZMACompressor(lzma.FORMAT_XZ)
+        else:
+            self._compressor = lambda: zlib.compressobj(6, zlib.DEFLATED, 31)
+        self._file = open(file_name, 'ab')
+        self._text = []
+
+    def write(self, text):
+        self._text.append(text)
+
+    def flush(self):
+        if not self._text:
+            return
+        text = ''.join(self._text)
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        c = self._compressor()
+        self._file.write(c.compress(text) + c.flush())
+        self._file.flush()
+        self._text = []
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+def pyramid_file(file_name, level):
+    '''
+    Returns name of the pyramid file of level for Data with file_name
+    (extension .pyr, the files are not data files for catalog and
+    dat_convert).
+    '''
+    return '%s.p%i.pyr' %(file_name, level)
+
+class _Pyramid(object):
+    '''
+    Min/max/mean summaries of the data rows at several decimation levels
+    (pyramid option of Data). Rows are collected and processed in blocks,
+    complete summaries are appended to the level files.
+    '''
+    def __init__(self, file_name, levels, delimiter='\t'):
+        self.levels = sorted(levels)
+        self.files = [pyramid_file(file_name, l) for l in self.levels]
+        self.delimiter = delimiter
+        self.block_rows = self.levels[0]*10
+        self.number_of_columns = None
+        self.rows = 0                       # rows processed
+        self._pending = []
+        self._acc = [None]*len(self.levels) # [start, count, min, max, sum]
+        for f in self.files:
+            open(f, 'w').close()
+
+    def add_row(self, row):
+        self._pending.append(row)
+        if len(self._pending) >= self.block_rows:
+            self.flush()
+
+    def add_block(self, block):
+        self.flush()
+        self._process(np.asarray(block, dtype=float))
+
+    def flush(self):
+        if self._pending:
+            block = np.array(self._pending, dtype=float)
+            self._pending = []
+            self._process(block)
+
+    def _process(self, block):
+        if self.number_of_columns is None:
+            self.number_of_columns = block.shape[1]
+        elif not block.shape[1] == self.number_of_columns:
+            raise RuntimeError(
+                "Pyramid: rows have %i values, expected %i" %(
+                    block.shape[1], self.number_of_columns))
+
+        for i, level in enumerate(self.levels):
+            lines = []
+            pos = 0
+            while pos < len(block):
+                acc = self._acc[i]
+                if acc is None:
+                    acc = self._acc[i] = [self.rows + pos, 0, None, None, None]
+                part = block[pos:pos + level - acc[1]]
+                mn, mx, sm = part.min(0), part.max(0), part.sum(0)
+                if acc[1]:
+                    mn = np.minimum(mn, acc[2])
+                    mx = np.maximum(mx, acc[3])
+                    sm = sm + acc[4]
+                acc[1] += len(part)
+                acc[2:] = mn, mx, sm
+                pos += len(part)
+                if acc[1] == level:
+                    summary = np.column_stack((mn, mx, sm/level)).ravel()
+                    lines.append(self.delimiter.join(
+                        [str(acc[0])] + [str(v) for v in summary.tolist()]) +
+                                 self.delimiter + '\n')
+                    self._acc[i] = None
+            if lines:
+                f = open(self.files[i], 'a')
+                f.write(''.join(lines))
+                f.close()
+        self.rows += len(block)
+
+def _next_specifier(specifier):
+    '''
+    Increases last digit of specifier or adds ".0" at the end of it.
+    Specifier ending by 9 is increased to 9.0
+    '''
+    #if last char. of string is a number except 9
+    if not specifier == '' and specifier[-1] in digits[:-1]:
+        return specifier[:-1] + str(int(specifier[-1]) + 1)
+    return specifier + '.0'
+
+def replace_file(src, dst):
+    '''
+    Renames file src to dst, dst is replaced if it exists (atomically,
+    where the system allows it).
+    '''
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        #python 2: os.rename does not overwrite existing file on Windows
+        try:
+            os.rename(src, dst)
+        except OSError:
+            os.remove(dst)
+            os.rename(src, dst)
 
 class Data(object):
-    def __init__(self,meas_name,specifier,file_path='',delimiter='\t'):
+    extension = '.dat'
+
+    def __init__(self,meas_name,specifier,file_path='',delimiter='\t',
+                 buffered=False,flush_rows=None,flush_interval=None,
+                 tmp_incremental=False,catalog=None,settings_sidecar=None,
+                 compress=None,rotate_bytes=None,rotate_interval=None,
+                 index_interval=60.0,columns=None,pyramid=None):
         '''
         Creates a data file with name meas_name+specifier . dat in
         file_path. Data are separated by delimiter.
@@ -32,76 +244,437 @@ class Data(object):
         
         meas_name, specifier - strings,
         delimiter - character for separation of data points
+
+        buffered - if True, the file stays open until close() (or the end
+        of a with block) instead of being opened and closed on every call.
+        Written data are flushed to the disk every flush_rows rows of
+        write_data, every flush_interval seconds or when flush() is called.
+        Default (False) opens the file for every write - the safest choice
+        when the script may crash.
+
+        tmp_incremental - if True, write_tmp_data appends only new rows
+        to the .tmp file when the previously written rows did not change.
+        Otherwise the whole file is written to a new file which then
+        replaces the old one, so readers (gnuplot) never see a half
+        written file.
+
+        catalog - meas_catalog.Catalog or name of its SQLite file. The file,
+        its headers, settings and footers are recorded in the catalog.
+
+        settings_sidecar - minimal length of iterable settings which are
+        not written into the header line value by value. Such array is
+        saved to sidecar file file_name.<sha1>.npy (can be loaded with
+        numpy.load(..., mmap_mode='r')), the header line contains its
+        first and last value, length, name and SHA1 checksum of the data.
+
+        compress - 'gzip' or 'lzma': data are written to compressed file
+        file_name.dat.gz (.dat.xz). Buffered mode is used, each flush
+        writes one complete compressed frame, so a crash loses only the
+        data after the last flush (flush_rows is 1000 if no flush policy
+        is given). meas_reader reads these files as the text ones.
+
+        rotate_bytes, rotate_interval - rotating mode for long logs: data
+        rows are written to a new shard file_name.001.dat, file_name.002.dat,
+        ... (file_name.dat is the first one) when the current shard
+        has rotate_bytes bytes or is older than rotate_interval seconds.
+        Index file file_name.idx gets a line "time shard offset" for the
+        first row of every shard and then every index_interval seconds,
+        meas_reader.read_time_range uses it to read only the needed part.
+
+        columns - schema of the data columns, list of tuples
+        (name, dtype, unit, fmt), only name is obligatory. Defaults:
+        dtype 'f8', unit '', fmt '%d' for integers, '%s' otherwise.
+        fill_header then adds line "#COLUMNS: name[unit]:dtype ..." and
+        write_data takes exactly one value per column, the row is made by
+        one precompiled format string (no checks of the values' types).
+
+        pyramid - tuple of decimation levels, e.g. (10, 100, 1000). For
+        every level L file file_name.pL.pyr (see pyramid_file) gets one
+        line per L data rows: index of the first row, then min, max and
+        mean of each column (column j of the data is in columns 3j+2,
+        3j+3, 3j+4 of the file, 1-based as in gnuplot). Only complete
+        blocks of L rows are written. meas_reader.load_overview picks the
+        level which fits a screen.
         '''
         self.delimiter = delimiter
         self.specifier = specifier
+        self.compress = compress
+        if compress:
+            if not compress in _COMPRESSED_EXTENSIONS:
+                raise RuntimeError('Invalid option. Either "gzip" or "lzma" can be used.')
+            self.extension = _COMPRESSED_EXTENSIONS[compress]
+            buffered = True
+            if flush_rows is None and flush_interval is None:
+                flush_rows = 1000
+        self.buffered = buffered
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self._handle = None
+        self._rows_since_flush = 0
+        self._last_flush = time.time()
+        self._row_formats = {}
+        self.tmp_incremental = tmp_incremental
+        self._tmp_columns = None        # data of the last write_tmp_data
+        self._segment = -1              # number of fill_header calls - 1
+        self.settings_sidecar = settings_sidecar
+        if isinstance(catalog, str):
+            from .meas_catalog import Catalog
+            catalog = Catalog(catalog)
+        self.catalog = catalog
+        self.rotate_bytes = rotate_bytes
+        self.rotate_interval = rotate_interval
+        self.index_interval = index_interval
+        self._shard = 0
+        self._shard_start = time.time()
+        self._shard_bytes = 0
+        self._next_index = None         # time of the next index entry
+        self.columns = _parse_columns(columns)
+        self._column_formats = None
+        self._schema_row_fmt = None
+        if self.columns:
+            self._column_formats = [c['fmt'] for c in self.columns]
+            self._schema_row_fmt = self._row_format(
+                len(self.columns), self._column_formats)
 
         if file_path and (not os.path.exists(file_path)):
             os.makedirs(file_path)
-        
-        self.file_name = os.path.join(file_path, meas_name + self.specifier)
-        
-        #if file already exists, this part of code increases specifier
-        #or add ".0" at the end of the file name. Specifier ending by 9
-        #is increased to 9.0
-        while os.path.isfile(self.file_name+'.dat'):
-            #if last char. of string is a number except 9
-            if not self.specifier == '' and self.specifier[-1] in digits[:-1]: 
-                ls = list(self.specifier)
-                ls[-1] = str(int(ls[-1]) + 1)
-                self.specifier = "".join(ls)
-            else:
-                self.specifier += '.0'
 
-            self.file_name = os.path.join(file_path, meas_name + self.specifier)    
-               
-        data=open(self.file_name+'.dat','a')
-        data.close()
+        self.pyramid = None
+        #names in the directory are read once. If file already exists,
+        #specifier is increased (see _next_specifier) until the name is
+        #free. The file is created exclusively, so if other process
+        #creates the same file meanwhile, the next specifier is used.
+        directory = os.path.dirname(os.path.join(file_path, meas_name)) or '.'
+        existing = set(os.path.normcase(n) for n in os.listdir(directory))
+        while True:
+            self.file_name = os.path.join(file_path, meas_name + self.specifier)
+            base = os.path.basename(self.file_name)
+            names = [os.path.normcase(base+self.extension)]
+            if rotate_bytes or rotate_interval:
+                names.append(os.path.normcase(base+'.idx'))
+            if not any(name in existing for name in names):
+                try:
+                    self._create()
+                    break
+                except OSError as e:
+                    if not e.errno == errno.EEXIST:
+                        raise
+                    existing.update(names)
+            self.specifier = _next_specifier(self.specifier)
+
+        if self.catalog is not None:
+            self.catalog.add_file(self.file_name+self.extension)
+
+        if pyramid:
+            self.pyramid = _Pyramid(self.file_name, pyramid, self.delimiter)
+
+        if buffered:
+            self._handle = self._open()
 
     def __repr__(self):
-        return '<Data file %s.dat>' %self.file_name
+        return '<Data file %s%s>' %(self.file_name, self.extension)
+
+    def _create(self):
+        '''
+        Creates the (empty) data file, raises OSError (EEXIST) if the file
+        already exists.
+        '''
+        os.close(os.open(self.file_name+self.extension, os.O_CREAT|os.O_EXCL|os.O_WRONLY))
+        if self.rotate_bytes or self.rotate_interval:
+            try:
+                os.close(os.open(self.file_name+'.idx', os.O_CREAT|os.O_EXCL|os.O_WRONLY))
+            except OSError:
+                os.remove(self.file_name+self.extension)
+                raise
+
+    def _open(self):
+        '''
+        Opens the data file (current shard) for appending.
+        '''
+        if self.compress:
+            return _FrameWriter(self.shard_file(), self.compress)
+        return open(self.shard_file(),'a')
+
+    def shard_file(self, shard=None):
+        '''
+        Returns name of the shard (current one by default) of the rotating
+        mode. Shard 0 is the data file itself.
+        '''
+        if shard is None: shard = self._shard
+        if shard == 0:
+            return self.file_name+self.extension
+        return '%s.%03i%s' %(self.file_name, shard, self.extension)
+
+    def _rotate(self, now):
+        '''
+        Starts new shard or writes index entry before data rows are written
+        (rotating mode).
+        '''
+        if ((self.rotate_interval and now - self._shard_start >= self.rotate_interval) or
+                (self.rotate_bytes and self._shard_bytes >= self.rotate_bytes)):
+            if self._handle is not None:
+                self._handle.close()
+            self._shard += 1
+            self._shard_start = now
+            self._shard_bytes = 0
+            open(self.shard_file(), 'a').close()
+            if self._handle is not None:
+                self._handle = self._open()
+            self._index(now)
+        elif self._next_index is None or now >= self._next_index:
+            self._index(now)
+
+    def _index(self, now):
+        '''
+        Writes index entry: time, name of the shard and offset of the next
+        row in it (start of a frame of compressed file).
+        '''
+        self._flush()
+        shard = self.shard_file()
+        idx = open(self.file_name+'.idx', 'a')
+        idx.write('%.3f\t%s\t%i\n' %(now, os.path.basename(shard), os.path.getsize(shard)))
+        idx.close()
+        self._next_index = now + self.index_interval
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write(self, text, rows=0):
+        '''
+        Appends text to the data file. rows is the number of data rows
+        in text, it is used by the flush policy of the buffered mode.
+        '''
+        if self.rotate_bytes or self.rotate_interval:
+            if rows:
+                self._rotate(time.time())
+            self._shard_bytes += len(text)
+
+        if self._handle is None:
+            data=self._open()
+            data.write(text)
+            data.close()
+            return
+
+        self._handle.write(text)
+        self._rows_since_flush += rows
+        if self.flush_rows and self._rows_since_flush >= self.flush_rows:
+            self._flush()
+        elif (self.flush_interval is not None and
+              time.time() - self._last_flush >= self.flush_interval):
+            self._flush()
+
+    def flush(self):
+        '''
+        Flushes buffered data to the file (buffered mode only).
+        '''
+        self._flush()
+        if self.pyramid is not None:
+            self.pyramid.flush()
+
+    def _flush(self):
+        if self._handle is not None:
+            self._handle.flush()
+        self._rows_since_flush = 0
+        self._last_flush = time.time()
+
+    def close(self):
+        '''
+        Flushes and closes the file of the buffered mode. Later writes
+        fall back to opening the file for every call.
+        '''
+        if self.pyramid is not None:
+            self.pyramid.flush()
+        if self._handle is not None:
+            self._flush()
+            self._handle.close()
+            self._handle = None
 
     def fill_header(self,sample, meas_type):
         '''
         Fills header of the data file.
         It add following lines: date, sample descriptions, mesaurement details
         '''
-        data=open(self.file_name+'.dat','a')
-        data.write('\n#DATE:\t\t%s\n' %time.ctime())     
-        data.write('#SAMPLE:\t\t%s\n' %sample)
-        data.write('#MEASUREMENT:\t%s\n' %meas_type)
-        data.close()
+        date = time.ctime()
+        self._write(self._header_text(date, sample, meas_type))
+        self._segment += 1
+        if self.catalog is not None:
+            self.catalog.add_run(
+                self.file_name+self.extension, self._segment, sample, meas_type, date)
 
     def fill_footer(self):
         '''
         Adds the time of the end of the measurement.
         '''
-        data=open(self.file_name+'.dat','a')
-        data.write('\n#END OF MEASUREMENT:\t\t%s\n' %time.ctime())
-        data.write('\n\n#--------------------------------------------------------------------------')
-        data.close()        
+        date = time.ctime()
+        self._write(self._footer_text(date))
+        self.flush()
+        if self.catalog is not None:
+            self.catalog.end_run(self.file_name+self.extension, max(self._segment, 0), date)
+
+    def _header_text(self, date, sample, meas_type):
+        return (
+            '\n#DATE:\t\t%s\n' %date +
+            '#SAMPLE:\t\t%s\n' %sample +
+            '#MEASUREMENT:\t%s\n' %meas_type +
+            self._columns_text()
+            )
+
+    def _columns_text(self):
+        if not self.columns:
+            return ''
+        return '#COLUMNS:\t%s\n' %'\t'.join(
+            '%s[%s]:%s' %(c['name'], c['unit'], c['dtype']) for c in self.columns)
+
+    def _footer_text(self, date):
+        return (
+            '\n#END OF MEASUREMENT:\t\t%s\n' %date +
+            '\n\n#--------------------------------------------------------------------------'
+            )
  
     def write_data(self, *data_list):
         '''
-        Writes data to the file, single value or array (dim N*1) of values
+        Writes data to the file, single value or array (dim N*1) of values.
+        With columns schema, data_list has to be one value for each column.
         '''
-        data=open(self.file_name+'.dat','a')
+        if self._schema_row_fmt is not None:
+            try:
+                line = self._schema_row_fmt %data_list
+            except TypeError:
+                raise RuntimeError(
+                    "Row %s does not match columns %s" %(
+                        data_list, [c['name'] for c in self.columns]))
+            self._write(line, rows=1)
+            if self.pyramid is not None:
+                self.pyramid.add_row(data_list)
+            return
+
+        line = ''
         for d in data_list:
             if hasattr(d,'__iter__'):
                 for di in d:
-                    data.write(str(di)+self.delimiter)
+                    line += str(di)+self.delimiter
+            else:
+                line += str(d)+self.delimiter
+        self._write(line+'\n', rows=1)
+        if self.pyramid is not None:
+            row = []
+            for d in data_list:
+                if hasattr(d,'__iter__'): row.extend(d)
+                else: row.append(d)
+            self.pyramid.add_row(row)
+
+    def write_rows(self, rows, fmt=None):
+        '''
+        Writes 2D array (list of rows or numpy array, dim M*N) to the file,
+        one row per line. The result is the same as calling
+        write_data(*row) for every row, but the whole block is formatted
+        at once (values of numpy array have its common dtype, write_rows
+        of int array gives 1, of float array 1.0).
+
+        fmt - format of the values, either a single string ('%.6e') or
+        a list of strings, one for each column. Default '%s' gives the
+        same text as write_data (formats of columns schema if it is set).
+        '''
+        if not isinstance(rows, np.ndarray):
+            #list of rows is formatted by columns, the types of the values
+            #are kept (ints are not converted to floats by numpy)
+            rows = list(rows)
+            if rows and not hasattr(rows[0], '__iter__'):
+                rows = [rows]
+            rows = [list(row) for row in rows]
+            if not rows or not rows[0]:
+                return
+            for row in rows:
+                if not len(row) == len(rows[0]):
+                    raise RuntimeError("Rows have to be of the same length")
+            text, length = self._format_columns(list(zip(*rows)), fmt)
+            self._write(text, rows=length)
+            if self.pyramid is not None:
+                self.pyramid.add_block(np.array(rows, dtype=float))
+            return
+        if rows.ndim == 1:
+            rows = rows.reshape(1, -1)
+        if rows.size == 0:
+            return
+        row_fmt = self._row_format(rows.shape[1], fmt)
+        self._write(
+            (row_fmt*rows.shape[0]) %tuple(_to_list(rows.ravel())),
+            rows=rows.shape[0]
+            )
+        if self.pyramid is not None:
+            self.pyramid.add_block(rows)
+
+    def write_columns(self, *columns, **kwargs):
+        '''
+        Writes *columns, which should be arrays of equal length, to the
+        file. i-th line contains i-th value of each array (as in
+        write_tmp_data). Optional keyword argument fmt has the same
+        meaning as in write_rows.
+        '''
+        text, length = self._format_columns(columns, kwargs.get('fmt'))
+        self._write(text, rows=length)
+        if self.pyramid is not None and length:
+            self.pyramid.add_block(np.column_stack(columns))
+
+    def pyramid_file(self, level):
+        '''
+        Returns name of the file of the pyramid level.
+        '''
+        return pyramid_file(self.file_name, level)
+
+    def _row_format(self, number_of_columns, fmt=None):
+        '''
+        Returns (and caches) format string of one row of the file.
+        '''
+        if fmt is None:
+            if self._column_formats and len(self._column_formats) == number_of_columns:
+                fmt = self._column_formats
             else:
-                data.write(str(d)+self.delimiter)
-        data.write('\n')    
-        data.close()
+                fmt = '%s'
+        key = (number_of_columns, fmt if isinstance(fmt, str) else tuple(fmt))
+        row_fmt = self._row_formats.get(key)
+        if row_fmt is None:
+            if isinstance(fmt, str):
+                fmt = [fmt]*number_of_columns
+            elif not len(fmt) == number_of_columns:
+                raise RuntimeError(
+                    "Number of formats is not equal to number of columns")
+            delimiter = self.delimiter.replace('%', '%%')
+            row_fmt = delimiter.join(fmt) + delimiter + '\n'
+            self._row_formats[key] = row_fmt
+        return row_fmt
+
+    def _format_columns(self, columns, fmt=None):
+        '''
+        Returns text of lines made of columns and number of the lines.
+        '''
+        #check if the data arrays have the same length
+        data_length = len(columns[0])
+        for d in columns:
+            if not len(d) == data_length:
+                raise RuntimeError("Data arrays have to be of the same length")
+
+        #values are interleaved into one flat list: column by column,
+        #each with step equal to number of columns
+        number_of_columns = len(columns)
+        values = [None]*(data_length*number_of_columns)
+        for i, d in enumerate(columns):
+            values[i::number_of_columns] = _to_list(d)
+
+        row_fmt = self._row_format(number_of_columns, fmt)
+        return (row_fmt*data_length) %tuple(values), data_length
         
     def write_note(self,note):
         '''
         Writes a note to the file.
         '''
-        data=open(self.file_name+'.dat','a')
-        data.write('#%s\n'%note)
-        data.close()
+        self._write(self._note_text(note))
+
+    def _note_text(self, note):
+        return '#%s\n'%note
 
     def write_settings(self, dict_of_variables):
         '''
@@ -109,18 +682,49 @@ class Data(object):
         an iterable, it writes first value, last value ,its length and then
         all the values.
         '''
-        data=open(self.file_name+'.dat','a')
-        for k,v in dict_of_variables.iteritems():
-            if hasattr(v,'__iter__'):
-                data.write('#%s[0]=%s \t'%(k,v[0]))
-                data.write('%s[-1]=%s \t'%(k,v[-1]))
-                data.write('length %s=%s \t values: '%(k,len(v)))
-                for v_i in v: data.write('%s \t'%v_i)
+        self._write(self._settings_text(dict_of_variables))
+        if self.catalog is not None:
+            self.catalog.add_settings(
+                self.file_name+self.extension, max(self._segment, 0), dict_of_variables)
+
+    def _settings_text(self, dict_of_variables):
+        lines = ''
+        for k,v in dict_of_variables.items():
+            if hasattr(v,'__iter__') and not isinstance(v, (str, bytes)):
+                lines += '#%s[0]=%s \t'%(k,v[0])
+                lines += '%s[-1]=%s \t'%(k,v[-1])
+                lines += 'length %s=%s \t'%(k,len(v))
+                sidecar = None
+                if self.settings_sidecar and len(v) >= self.settings_sidecar:
+                    sidecar = self._write_sidecar(v)
+                if sidecar:
+                    lines += ' sidecar: %s sha1=%s \t'%sidecar
+                else:
+                    lines += ' values: '
+                    for v_i in v: lines += '%s \t'%v_i
             else:
-                data.write('#%s=%s \t'%(k,v))
-            data.write('\n')
-        data.close()
+                lines += '#%s=%s \t'%(k,v)
+            lines += '\n'
+        return lines
     
+    def _write_sidecar(self, values):
+        '''
+        Saves values to .npy file named by their checksum. Returns
+        (file name without directory, sha1) or None if the values can not
+        be stored without pickling.
+        '''
+        values = np.ascontiguousarray(values)
+        if values.dtype.hasobject:
+            return None
+        sha1 = array_sha1(values)
+        sidecar_file = '%s.%s.npy' %(self.file_name, sha1[:16])
+        if not os.path.exists(sidecar_file):        # same array already saved
+            f = open(sidecar_file+'~', 'wb')
+            np.save(f, values)
+            f.close()
+            replace_file(sidecar_file+'~', sidecar_file)
+        return os.path.basename(sidecar_file), sha1
+
     def write_tmp_data(self, *data_list):
         '''
         Writes *data, which should be arrays (lists, tuples, numpy_arrays,..)
@@ -128,18 +732,237 @@ class Data(object):
         in a temporary file with the same name as the instance datafile,
          only the extension is not ".dat", but ".tmp"
         '''
-        
-        #check if the data arrays have the same length
-        data_length = len(data_list[0])
-        for d in data_list:
-            if not len(d) == data_length:
-                raise RuntimeError("Data arrays have to be of the same length")
+        if not self.tmp_incremental:
+            text, data_length = self._format_columns(data_list)
+            data=open(self.file_name+'.tmp','w')
+            data.write(text)
+            data.close()
+            return
 
-        data=open(self.file_name+'.tmp','w')
-        for i in range(data_length):
-            for d in data_list:
-                data.write(str(d[i]) + self.delimiter)
-            data.write('\n')
+        columns = [np.array(d) for d in data_list]
+        old = self._tmp_columns
+        old_length = len(old[0]) if old else 0
+        if (old and len(columns) == len(old) and
+                os.path.isfile(self.file_name+'.tmp') and
+                all(len(c) >= old_length and np.array_equal(c[:old_length], o)
+                    for c, o in zip(columns, old))):
+            #only new rows are appended
+            text, data_length = self._format_columns(
+                [d[old_length:] for d in data_list])
+            if data_length:
+                data=open(self.file_name+'.tmp','a')
+                data.write(text)
+                data.close()
+        else:
+            text, data_length = self._format_columns(data_list)
+            data=open(self.file_name+'.tmp~','w')
+            data.write(text)
+            data.close()
+            replace_file(self.file_name+'.tmp~', self.file_name+'.tmp')
+        self._tmp_columns = columns
 
-        data.close()
-        
+
+class AsyncData(Data):
+    def __init__(self,meas_name,specifier,file_path='',delimiter='\t',
+                 queue_size=1000,**kwargs):
+        '''
+        Data which are written to the file by a background thread.
+        Rows are passed to the thread through a queue of queue_size items.
+        When the queue is full, write_data waits until there is a free
+        place (the measurement is slowed down rather than the memory
+        exhausted). After an exception in the writer thread nothing more
+        is written to the file (the rows in the queue are dropped) and the
+        exception is raised again by every call of a writing method until
+        close(), which raises it too.
+        fill_footer(), flush() and close() return only after everything
+        in the queue was written.
+
+        Other arguments are the same as for Data (buffered, flush_rows,
+        flush_interval).
+        '''
+        Data.__init__(self,meas_name,specifier,file_path,delimiter,**kwargs)
+
+        self._queue = queue.Queue(queue_size)
+        self._error = None
+        self._stats_lock = threading.Lock()
+        self.rows_written = 0
+        self.max_queue_depth = 0
+        self.blocked_time = 0.0         # time spent waiting for full queue
+        self.write_time = 0.0           # total time of the file writes
+        self.max_write_time = 0.0
+        self._writes = 0
+
+        self._writer = threading.Thread(target=self._run)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def __repr__(self):
+        return '<AsyncData file %s%s>' %(self.file_name, self.extension)
+
+    def _run(self):
+        '''
+        Writer thread. Items in the queue are (text, rows), text None
+        means flush, item None stops the thread. All items waiting in the
+        queue are taken at once and their texts are written by one write
+        (the file is opened once, not for every row).
+        '''
+        while True:
+            items = [self._queue.get()]
+            while items[-1] is not None:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                texts, rows = [], 0
+                for item in items:
+                    if item is not None and item[0] is not None:
+                        texts.append(item[0])
+                        rows += item[1]
+                        continue
+                    if texts:
+                        self._timed_write(''.join(texts), rows)
+                        texts, rows = [], 0
+                    if item is not None:
+                        self._timed_write(None, 0)
+                if texts:
+                    self._timed_write(''.join(texts), rows)
+            except Exception as e:
+                self._error = e
+            finally:
+                for item in items:
+                    self._queue.task_done()
+            if items[-1] is None:
+                return
+
+    def _timed_write(self, text, rows):
+        '''
+        Writes (text None - flushes) the file in the writer thread.
+        '''
+        if self._error is not None:
+            return              # the file is not written after an error
+        t0 = time.time()
+        if text is None:
+            Data._flush(self)
+        else:
+            Data._write(self, text, rows)
+        dt = time.time() - t0
+        with self._stats_lock:
+            self.rows_written += rows
+            self.write_time += dt
+            self._writes += 1
+            if dt > self.max_write_time: self.max_write_time = dt
+
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _write(self, text, rows=0):
+        self._check_error()
+        if not self._writer.is_alive():
+            raise RuntimeError('%r is closed' %self)
+
+        item = (text, rows)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            t0 = time.time()
+            self._queue.put(item)
+            self.blocked_time += time.time() - t0
+
+        depth = self._queue.qsize()
+        if depth > self.max_queue_depth: self.max_queue_depth = depth
+
+    def flush(self):
+        '''
+        Waits until the queue is written and flushes the file.
+        '''
+        self._write(None)
+        self._queue.join()
+        self._check_error()
+        if self.pyramid is not None:
+            self.pyramid.flush()
+
+    def close(self):
+        '''
+        Writes everything in the queue, stops the writer thread
+        and closes the file.
+        '''
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        if self._error is None:
+            Data.close(self)
+            return
+        #failed handle is not flushed, the original exception is raised
+        if self._handle is not None:
+            try:
+                self._handle.close()
+            except Exception:
+                pass
+            self._handle = None
+        self._check_error()
+
+    def stats(self):
+        '''
+        Returns dictionary with the current queue depth, maximal queue
+        depth, number of written rows, time spent waiting for the full
+        queue and mean and maximal duration of one file write [s].
+        '''
+        with self._stats_lock:
+            writes = self._writes
+            return {
+                'queue_depth': self._queue.qsize(),
+                'max_queue_depth': self.max_queue_depth,
+                'rows_written': self.rows_written,
+                'blocked_time': self.blocked_time,
+                'mean_write_time': self.write_time/writes if writes else 0.0,
+                'max_write_time': self.max_write_time,
+                }
+
+
+# test
+def benchmark_compression(rows=100000, file_path=None):
+    '''
+    Writes the same slowly drifting log (time, temperature, field, value)
+    as plain text (default and buffered mode) and compressed by gzip and
+    lzma. Prints and returns rows/second and bytes/row of each mode.
+    '''
+    import shutil
+    import tempfile
+
+    rng = np.random.RandomState(0)
+    log = np.column_stack((
+        1.45e9 + np.arange(rows)*0.5,
+        0.3 + np.cumsum(rng.normal(0, 1e-4, rows)).round(5),
+        np.round(np.cumsum(rng.normal(0, 1e-3, rows)), 4),
+        rng.normal(1e-3, 1e-5, rows),
+        )).tolist()
+
+    modes = [('text', {}), ('text buffered', {'buffered': True, 'flush_rows': 1000})]
+    modes.append(('gzip', {'compress': 'gzip'}))
+    try:
+        import lzma
+        modes.append(('lzma', {'compress': 'lzma'}))
+    except ImportError:
+        pass
+
+    directory = file_path or tempfile.mkdtemp()
+    results = {}
+    try:
+        for name, kwargs in modes:
+            data = Data('benchmark', '0', directory, **kwargs)
+            t0 = time.time()
+            data.fill_header('benchmark', name)
+            for row in log:
+                data.write_data(*row)
+            data.fill_footer()
+            data.close()
+            dt = time.time() - t0
+            size = os.path.getsize(data.file_name+data.extension)
+            results[name] = (rows/dt, size/float(rows))
+            print('%-14s %10.0f rows/s %8.2f bytes/row' %(name, rows/dt, size/float(rows)))
+    finally:
+        if file_path is None:
+            shutil.rmtree(directory)
+    return results
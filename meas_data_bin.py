@@ -0,0 +1,314 @@
+'''
+Binary columnar storage of measurement data.
+
+BinData has the same interface as meas_data.Data, but data rows are
+stored in a directory meas_name+specifier.bin with one .npy file (float64)
+per column. Rows are collected in chunks of chunk_rows rows and appended
+to the column files, the .npy headers are updated after every chunk, so
+the files can be loaded at any time by numpy.load (also with
+mmap_mode='r'). Header, settings and notes are kept in meta.json, the
+non-data lines of the text file (for to_dat()) are appended to events.json
+(one json list [row, text] per line).
+
+Usage:
+
+import lab233.meas_data_bin
+data = lab233.meas_data_bin.BinData('new_data','0.0')
+data.fill_header('MoC','RT')
+data.write_settings(sett)
+data.write_data(1,2,3)
+data.fill_footer()
+data.close()
+
+columns = data.load()               # list of arrays, one for each column
+data.to_dat()                       # legacy text file new_data0.0.dat
+lab233.meas_data_bin.bin_to_dat('new_data0.0.bin')
+'''
+import os
+import json
+import time
+import struct
+import numpy as np
+
+from .meas_data import Data, replace_file, _to_list
+
+NPY_HEADER_SIZE = 128       # fixed size, so the header can be rewritten in place
+META_FILE = 'meta.json'
+EVENTS_FILE = 'events.json'
+
+
+def _npy_header(dtype, length):
+    '''
+    Returns .npy (version 1.0) header of 1D array padded to NPY_HEADER_SIZE.
+    '''
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%i,), }" %(
+        np.dtype(dtype).str, length)
+    header = header.ljust(NPY_HEADER_SIZE - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+def _json_default(obj):
+    '''
+    Converts numpy values in settings to types known by json.
+    '''
+    if isinstance(obj, np.ndarray) or isinstance(obj, np.generic):
+        return obj.tolist()
+    if hasattr(obj, '__iter__'):
+        return list(obj)
+    return str(obj)
+
+
+class BinData(Data):
+    extension = '.bin'
+
+    def __init__(self,meas_name,specifier,file_path='',delimiter='\t',
+                 chunk_rows=1000,dtype=np.float64,columns=None):
+        '''
+        Creates directory meas_name+specifier . bin in file_path. Specifier
+        is increased as in meas_data.Data.
+
+        chunk_rows - number of rows kept in memory before they are
+        appended to the column files
+        dtype - data type of the columns
+        columns - columns schema as in meas_data.Data, the column files
+        have the dtypes of the schema
+        delimiter - used only for conversion to the text file
+        '''
+        self.chunk_rows = chunk_rows
+        self.dtype = np.dtype(dtype)
+        self.dtypes = None              # dtype of each column
+        self.number_of_columns = None
+        self.rows = 0               # rows in the column files
+        self.runs = []              # header, settings and notes of fill_header blocks
+        self._chunk = []
+        Data.__init__(self,meas_name,specifier,file_path,delimiter,columns=columns)
+
+    def __repr__(self):
+        return '<BinData file %s.bin>' %self.file_name
+
+    def _create(self):
+        os.mkdir(self.file_name+'.bin')
+        self._write_meta()
+
+    def _column_file(self, i):
+        return os.path.join(self.file_name+'.bin', 'col%03i.npy' %i)
+
+    def _write_meta(self):
+        meta = {
+            'delimiter': self.delimiter,
+            'dtypes': [dt.str for dt in self.dtypes] if self.dtypes else None,
+            'schema': self.columns,
+            'columns': self.number_of_columns,
+            'rows': self.rows,
+            'runs': self.runs,
+            }
+        tmp_name = os.path.join(self.file_name+'.bin', META_FILE+'.tmp')
+        f = open(tmp_name, 'w')
+        json.dump(meta, f, default=_json_default, indent=1)
+        f.close()
+        replace_file(tmp_name, os.path.join(self.file_name+'.bin', META_FILE))
+
+    def _run(self):
+        '''
+        Returns metadata of the current run (last fill_header).
+        '''
+        if not self.runs:
+            self.runs.append({
+                'date': None, 'sample': None, 'measurement': None,
+                'start_row': 0, 'end': None, 'settings': {}, 'notes': [],
+                })
+        return self.runs[-1]
+
+    def _write(self, text, rows=0):
+        '''
+        Non-data text is appended to the events file for to_dat().
+        '''
+        f = open(os.path.join(self.file_name+'.bin', EVENTS_FILE), 'a')
+        f.write(json.dumps([self.rows + len(self._chunk), text]) + '\n')
+        f.close()
+
+    def _set_columns(self, number_of_columns):
+        '''
+        Creates the column files for the first row, checks the number of
+        values of the next rows.
+        '''
+        if self.dtypes is None:
+            if self.columns:
+                self.dtypes = [np.dtype(c['dtype']) for c in self.columns]
+            else:
+                self.dtypes = [self.dtype]*number_of_columns
+            self.number_of_columns = len(self.dtypes)
+            for i, dtype in enumerate(self.dtypes):
+                f = open(self._column_file(i), 'wb')
+                f.write(_npy_header(dtype, 0))
+                f.close()
+        if not number_of_columns == self.number_of_columns:
+            raise RuntimeError(
+                "Row has %i values, the file has %i columns" %(
+                    number_of_columns, self.number_of_columns))
+
+    def _append_block(self, columns):
+        '''
+        Appends list of column arrays of equal length to the column files.
+        '''
+        self._set_columns(len(columns))
+        length = self.rows + len(columns[0])
+        for i, (column, dtype) in enumerate(zip(columns, self.dtypes)):
+            f = open(self._column_file(i), 'r+b')
+            f.seek(0, 2)
+            f.write(np.ascontiguousarray(column, dtype=dtype).tobytes())
+            f.seek(0)
+            f.write(_npy_header(dtype, length))
+            f.close()
+        self.rows = length
+
+    def _flush(self):
+        if self._chunk:
+            columns = list(zip(*self._chunk))
+            self._chunk = []
+            self._append_block(columns)
+        self._write_meta()
+
+    def close(self):
+        self._flush()
+
+    def fill_header(self, sample, meas_type):
+        date = time.ctime()
+        self.runs.append({
+            'date': date, 'sample': sample, 'measurement': meas_type,
+            'start_row': self.rows + len(self._chunk), 'end': None,
+            'settings': {}, 'notes': [],
+            })
+        self._write(self._header_text(date, sample, meas_type))
+        self._write_meta()
+
+    def fill_footer(self):
+        date = time.ctime()
+        self._run()['end'] = date
+        self._write(self._footer_text(date))
+        self.flush()
+
+    def write_note(self, note):
+        self._run()['notes'].append(note)
+        Data.write_note(self, note)
+
+    def write_settings(self, dict_of_variables):
+        self._run()['settings'].update(dict_of_variables)
+        Data.write_settings(self, dict_of_variables)
+
+    def write_data(self, *data_list):
+        row = []
+        for d in data_list:
+            if hasattr(d,'__iter__'):
+                row.extend(d)
+            else:
+                row.append(d)
+        self._set_columns(len(row))
+        self._chunk.append(row)
+        if len(self._chunk) >= self.chunk_rows:
+            self._flush()
+
+    def write_rows(self, rows, fmt=None):
+        '''
+        Appends 2D array of rows. fmt is ignored.
+        '''
+        rows = np.asarray(rows)
+        if rows.ndim == 1:
+            rows = rows.reshape(1, -1)
+        if rows.size == 0:
+            return
+        self._flush()
+        self._append_block([rows[:, i] for i in range(rows.shape[1])])
+        self._write_meta()
+
+    def write_columns(self, *columns, **kwargs):
+        '''
+        Appends columns of equal length. fmt is ignored.
+        '''
+        data_length = len(columns[0])
+        for d in columns:
+            if not len(d) == data_length:
+                raise RuntimeError("Data arrays have to be of the same length")
+        if not data_length:
+            return
+        self._flush()
+        self._append_block(columns)
+        self._write_meta()
+
+    def load(self, mmap_mode=None):
+        '''
+        Returns list of column arrays (flushes the data first).
+        '''
+        self.flush()
+        return load_bin(self.file_name+'.bin', mmap_mode)[0]
+
+    def to_dat(self, dat_file_name=None):
+        '''
+        Writes the data to the legacy text file (file_name.dat by default).
+        '''
+        self.flush()
+        return bin_to_dat(self.file_name+'.bin', dat_file_name)
+
+
+def load_bin(bin_dir, mmap_mode=None):
+    '''
+    Returns (columns, meta) of directory created by BinData. columns is
+    a list of arrays, meta is the dictionary from meta.json with list
+    events ([row, text] of the non-data lines) from events.json.
+    '''
+    f = open(os.path.join(bin_dir, META_FILE))
+    meta = json.load(f)
+    f.close()
+    events_file = os.path.join(bin_dir, EVENTS_FILE)
+    if os.path.exists(events_file):
+        f = open(events_file)
+        meta['events'] = [json.loads(line) for line in f if line.strip()]
+        f.close()
+    else:
+        meta.setdefault('events', [])   # older directories keep them in meta.json
+    columns = []
+    for i in range(meta['columns'] or 0):
+        col = np.load(os.path.join(bin_dir, 'col%03i.npy' %i), mmap_mode=mmap_mode)
+        columns.append(col[:meta['rows']])
+    return columns, meta
+
+
+def bin_to_dat(bin_dir, dat_file_name=None, block_rows=100000):
+    '''
+    Converts directory created by BinData to the text file written by
+    meas_data.Data (header, settings, notes and footer at the same places).
+    Default name of the file is the name of the directory with
+    extension .dat instead of .bin. Values are written by str() (or by
+    formats of the columns schema), so the text of float values is the
+    same as from meas_data.Data.
+    Returns name of the text file.
+    '''
+    bin_dir = bin_dir.rstrip('/\\')
+    if dat_file_name is None:
+        dat_file_name = os.path.splitext(bin_dir)[0] + '.dat'
+    columns, meta = load_bin(bin_dir, mmap_mode='r')
+    delimiter = meta['delimiter'].replace('%', '%%')
+    if meta.get('schema'):
+        fmts = [c['fmt'] for c in meta['schema']]
+    else:
+        fmts = ['%s']*len(columns)
+    row_fmt = delimiter.join(fmts) + delimiter + '\n'
+
+    out = open(dat_file_name, 'w')
+
+    def write_rows(start, stop):
+        for i in range(start, stop, block_rows):
+            j = min(i + block_rows, stop)
+            values = [None]*((j-i)*len(columns))
+            for k, c in enumerate(columns):
+                values[k::len(columns)] = _to_list(c[i:j])
+            out.write((row_fmt*(j-i)) %tuple(values))
+
+    row = 0
+    for event_row, text in meta['events']:
+        write_rows(row, event_row)
+        out.write(text)
+        row = event_row
+    write_rows(row, meta['rows'])
+    out.close()
+    return dat_file_name
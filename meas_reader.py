@@ -0,0 +1,505 @@
+'''
+Reading of the data files written by meas_data.Data.
+
+One file can contain several measurements (segments): each fill_header
+starts a new segment with the #DATE line, fill_footer ends it. The file
+is memory-mapped and the offsets of the segments, their headers, settings
+and notes are found in one pass when DataReader is created. Data are
+parsed only when load() asks for them, only for one segment.
+
+Usage:
+
+import lab233.meas_reader
+reader = lab233.meas_reader.DataReader('new_data0.0.dat')
+len(reader)                             # number of segments
+reader.segments[-1]['sample']           # #SAMPLE of the last segment
+reader.segments[-1]['settings']         # dictionary from write_settings
+f, amp = reader.load(-1, columns=[0, 1]).T
+reader.close()
+
+data = lab233.meas_reader.load_data('new_data0.0.dat', segment=0)
+
+level, overview = lab233.meas_reader.load_overview('new_data0.0', 2000)
+'''
+import os
+import re
+import bisect
+import hashlib
+import mmap
+import zlib
+import numpy as np
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_XZ_MAGIC = b'\xfd7zXZ\x00'
+_COMMENT_LINE = re.compile(br'#[^\n]*')
+_BLANK_LINE = re.compile(br'^[ \t\r]*(\n|$)', re.M)
+
+
+def _decompress_frames(raw, decompressor, chunk_size=1<<20):
+    '''
+    Decompresses concatenated gzip members (xz streams) of compressed
+    Data file. Frame cut by a crash is decompressed as far as possible,
+    its incomplete last line is dropped.
+    '''
+    out = []
+    pos = 0
+    while pos < len(raw):
+        d = decompressor()
+        while pos < len(raw):
+            chunk = raw[pos:pos+chunk_size]
+            pos += len(chunk)
+            out.append(d.decompress(chunk))
+            if d.unused_data:           # next frame starts in this chunk
+                pos -= len(d.unused_data)
+                break
+    text = b''.join(out)
+    if text.endswith(b'\n') or text.endswith(b'-'):     # complete (footer)
+        return text
+    return text[:text.rfind(b'\n')+1]
+
+
+def _to_value(s):
+    '''
+    Converts string from the settings line to int, float or leaves it
+    as string.
+    '''
+    for conv in (int, float):
+        try:
+            return conv(s)
+        except ValueError:
+            pass
+    return s
+
+
+def array_sha1(values):
+    '''
+    Returns sha1 (hex) of the array including its dtype and shape, arrays
+    with the same bytes but different dtype or shape differ.
+    '''
+    values = np.ascontiguousarray(values)
+    sha1 = hashlib.sha1(('%s %s ' %(values.dtype.str, values.shape)).encode('ascii'))
+    sha1.update(values.tobytes())
+    return sha1.hexdigest()
+
+
+def load_sidecar(file_name, sha1=None, mmap_mode='r'):
+    '''
+    Loads array saved in sidecar file by Data.write_settings (memory
+    mapped by default). If sha1 is given, the data are checked against
+    it (the whole file is read).
+    '''
+    values = np.load(file_name, mmap_mode=mmap_mode)
+    if sha1 is not None:
+        if not array_sha1(values) == sha1:
+            raise RuntimeError('Checksum of %s does not match' %file_name)
+    return values
+
+
+def parse_settings_line(line, directory=''):
+    '''
+    Parses line written by Data.write_settings (without leading '#').
+    Returns (key, value), value is numpy array for iterables. Arrays
+    stored in sidecar files (in directory) are memory mapped, value is
+    None if the sidecar file does not exist.
+    '''
+    if ' sidecar: ' in line:
+        head, ref = line.split(' sidecar: ', 1)
+        key = head.split('[0]=', 1)[0]
+        sidecar_file = os.path.join(directory, ref.split(' sha1=')[0].strip())
+        if not os.path.isfile(sidecar_file):
+            return key, None
+        return key, load_sidecar(sidecar_file)
+    if ' values: ' in line:
+        head, values = line.split(' values: ', 1)
+        key = head.split('[0]=', 1)[0]
+        return key, np.array([_to_value(v.strip())
+                              for v in values.split('\t') if v.strip()])
+    key, value = line.split('=', 1)
+    return key, _to_value(value.strip())
+
+
+def parse_columns_line(line):
+    '''
+    Parses line written by Data with columns schema (without leading '#'):
+    "COLUMNS: name[unit]:dtype ...". Returns list of dictionaries.
+    '''
+    columns = []
+    for item in line.split(':', 1)[1].split('\t'):
+        if not item.strip():
+            continue
+        name_unit, dtype = item.rsplit(':', 1)
+        name, unit = name_unit.split('[', 1)
+        columns.append({'name': name.strip(), 'unit': unit.rstrip(']'),
+                        'dtype': dtype.strip()})
+    return columns
+
+
+def _new_segment(start):
+    return {
+        'start': start,         # offset of the #DATE line
+        'data_start': None,     # offset of the first data line
+        'data_end': None,       # offset of #END OF MEASUREMENT (or end)
+        'end': None,            # offset of the next segment
+        'date': None,
+        'sample': None,
+        'measurement': None,
+        'end_date': None,
+        'columns': None,        # schema from #COLUMNS line
+        'settings': {},
+        'notes': [],
+        }
+
+
+class DataReader(object):
+    def __init__(self, file_name, delimiter='\t'):
+        '''
+        Opens file_name (.dat file of meas_data.Data) and builds index of
+        its segments (list self.segments of dictionaries).
+        delimiter - separator of the data values used in the file
+        '''
+        self.file_name = file_name
+        self.delimiter = delimiter.encode('latin1') if not isinstance(delimiter, bytes) else delimiter
+        self._file = open(file_name, 'rb')
+        if os.fstat(self._file.fileno()).st_size:
+            self._buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._buf = b''         # empty file can not be mapped
+
+        #compressed files (Data(...,compress=...)) are decompressed to memory
+        if self._buf[:2] == _GZIP_MAGIC:
+            raw, self._buf = self._buf, _decompress_frames(
+                self._buf, lambda: zlib.decompressobj(31))
+            raw.close()
+        elif self._buf[:6] == _XZ_MAGIC:
+            import lzma
+            raw, self._buf = self._buf, _decompress_frames(
+                self._buf, lzma.LZMADecompressor)
+            raw.close()
+        self.segments = self._build_index()
+
+    def __repr__(self):
+        return '<DataReader %s, %i segments>' %(self.file_name, len(self.segments))
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if isinstance(self._buf, mmap.mmap):
+            self._buf.close()
+        self._file.close()
+
+    def _build_index(self):
+        '''
+        One pass over the lines starting with '#' (found by find, data
+        lines are skipped at C speed). Every #DATE line opens a segment,
+        the first non-comment line after it is the start of data.
+        '''
+        buf = self._buf
+        size = len(buf)
+        segments = []
+        seg = _new_segment(0)       # data written before first fill_header
+        pos = 0
+        while pos < size:
+            if buf[pos:pos+1] == b'#':
+                line_end = buf.find(b'\n', pos)
+                if line_end < 0: line_end = size
+                line = buf[pos+1:line_end].rstrip(b'\r').decode('latin1')
+
+                if line.startswith('DATE:'):
+                    if seg['date'] is not None or seg['data_start'] is not None:
+                        self._close_segment(seg, pos)
+                        segments.append(seg)
+                        seg = _new_segment(pos)
+                    else:
+                        #settings and notes written before fill_header
+                        seg['start'] = pos
+                    seg['date'] = line[5:].strip()
+                elif line.startswith('SAMPLE:'):
+                    seg['sample'] = line[7:].strip()
+                elif line.startswith('MEASUREMENT:'):
+                    seg['measurement'] = line[12:].strip()
+                elif line.startswith('COLUMNS:'):
+                    seg['columns'] = parse_columns_line(line)
+                elif line.startswith('END OF MEASUREMENT:'):
+                    seg['end_date'] = line[19:].strip()
+                    if seg['data_end'] is None: seg['data_end'] = pos
+                elif line.startswith('-----'):
+                    pass
+                elif '=' in line and line.endswith(' \t'):
+                    #settings lines end with ' \t', notes may contain '='
+                    k, v = parse_settings_line(
+                        line, os.path.dirname(self.file_name))
+                    seg['settings'][k] = v
+                else:
+                    seg['notes'].append(line)
+                pos = line_end + 1
+                continue
+
+            #data line (or empty line)
+            if seg['data_start'] is None:
+                line_end = buf.find(b'\n', pos)
+                if line_end < 0: line_end = size
+                if not buf[pos:line_end].strip():
+                    pos = line_end + 1
+                    continue
+                seg['data_start'] = pos
+
+            #skip to the next comment line
+            next_comment = buf.find(b'\n#', pos)
+            if next_comment < 0:
+                break
+            pos = next_comment + 1
+
+        if seg['date'] is not None or seg['data_start'] is not None:
+            self._close_segment(seg, size)
+            segments.append(seg)
+        return segments
+
+    def _close_segment(self, seg, end):
+        seg['end'] = end
+        if seg['data_end'] is None: seg['data_end'] = end
+        if seg['data_start'] is None: seg['data_start'] = seg['data_end']
+
+    def load(self, segment=-1, columns=None, block_size=1<<26):
+        '''
+        Returns data of the segment as 2D array (rows*columns).
+        columns - list of column indices (0-based) or names (if the file
+        has columns schema), all columns by default
+        block_size - size of blocks [bytes] in which the text is parsed,
+        only the selected columns of each block are kept
+        '''
+        if not self.segments:
+            raise RuntimeError('%s contains no data' %self.file_name)
+        seg = self.segments[segment]
+        number_of_columns = None
+        if seg['columns']:
+            #schema: number of columns is known, names can be used
+            number_of_columns = len(seg['columns'])
+            if columns is not None:
+                names = [c['name'] for c in seg['columns']]
+                columns = [names.index(c) if isinstance(c, str) else c
+                           for c in columns]
+        return parse_range(self._buf, seg['data_start'], seg['data_end'],
+                           columns, self.delimiter, block_size, number_of_columns)
+
+    def load_records(self, segment=-1):
+        '''
+        Returns data of the segment with columns schema as numpy record
+        array with the names and dtypes of the schema.
+        '''
+        seg = self.segments[segment]
+        if not seg['columns']:
+            raise RuntimeError('Segment %i has no columns schema' %segment)
+        data = self.load(segment)
+        records = np.empty(len(data), dtype=[
+            (str(c['name']), c['dtype']) for c in seg['columns']])
+        for i, c in enumerate(seg['columns']):
+            records[c['name']] = data[:, i]
+        return records.view(np.recarray)
+
+
+def _count_columns(text, delimiter):
+    '''
+    Returns number of values on the first non-empty line of text.
+    '''
+    line_start = 0
+    while line_start < len(text):
+        line_end = text.find(b'\n', line_start)
+        if line_end < 0: line_end = len(text)
+        line = text[line_start:line_end].strip()
+        if line:
+            if delimiter.strip():
+                return len([v for v in line.split(delimiter) if v.strip()])
+            return len(line.split())
+        line_start = line_end + 1
+    return None
+
+
+def parse_range(buf, start, stop, columns=None, delimiter=b'\t',
+                block_size=1<<26, number_of_columns=None):
+    '''
+    Parses data lines in buf[start:stop] (buf is bytes or mmap), comment
+    lines are skipped. Text is parsed in blocks of block_size bytes, only
+    the selected columns of each block are kept. Returns 2D array.
+    number_of_columns is found from the first line if not given.
+    '''
+    blocks = []
+    pos = start
+    while pos < stop:
+        block_end = min(pos + block_size, stop)
+        if block_end < stop:
+            #block ends at the end of a line
+            nl = buf.rfind(b'\n', pos, block_end)
+            if nl < 0: nl = buf.find(b'\n', block_end, stop)
+            block_end = nl + 1 if nl >= 0 else stop
+        text = buf[pos:block_end]
+        pos = block_end
+        if b'#' in text:
+            text = _COMMENT_LINE.sub(b'', text)
+        if number_of_columns is None:
+            number_of_columns = _count_columns(text, delimiter)
+            if number_of_columns is None:
+                continue
+        block = parse_block(text, number_of_columns, delimiter)
+        if columns is not None:
+            block = block[:, columns]
+        blocks.append(block)
+
+    if not blocks:
+        return np.zeros((0, len(columns) if columns is not None else 0))
+    return np.concatenate(blocks)
+
+
+def parse_block(text, number_of_columns, delimiter=b'\t'):
+    '''
+    Parses text of data lines (no comments) to 2D float array with
+    number_of_columns columns. Missing values of shorter lines are nan.
+    '''
+    if delimiter.strip():
+        text = text.replace(delimiter, b' ')
+    text = text.strip()
+    if b'\n\n' in text or b'\n\r\n' in text:
+        text = _BLANK_LINE.sub(b'', text)
+    number_of_lines = text.count(b'\n') + 1 if text else 0
+    try:
+        values = np.fromstring(text, sep=' ')
+    except ValueError:          # text which is not a number (new numpy)
+        values = None
+    if values is not None and values.size == number_of_lines*number_of_columns:
+        return values.reshape(-1, number_of_columns)
+
+    #lines of different length or values which are not numbers
+    lines = text.splitlines()
+    block = np.empty((len(lines), number_of_columns))
+    block.fill(np.nan)
+    for i, line in enumerate(lines):
+        for j, v in enumerate(line.split()[:number_of_columns]):
+            try:
+                block[i, j] = float(v)
+            except ValueError:
+                pass
+    return block
+
+
+def load_data(file_name, segment=-1, columns=None, delimiter='\t'):
+    '''
+    Returns data of one segment of the file as 2D array, see DataReader.load.
+    '''
+    reader = DataReader(file_name, delimiter)
+    try:
+        return reader.load(segment, columns)
+    finally:
+        reader.close()
+
+
+def load_overview(file_name, max_points=2000, delimiter='\t'):
+    '''
+    Returns (level, array) of the finest pyramid level (see the pyramid
+    option of meas_data.Data) with at most about max_points lines.
+    file_name is the file_name of the Data (also accepted with the .dat
+    extension). Column 0 of the array is the index of the first row of
+    the block, then min, max and mean of every data column follow.
+    If no level is small enough the coarsest one is returned.
+    '''
+    from .meas_data import pyramid_file
+    if file_name.endswith('.dat'): file_name = file_name[:-4]
+    if not isinstance(delimiter, bytes): delimiter = delimiter.encode('latin1')
+    prefix = os.path.basename(file_name) + '.p'
+    directory = os.path.dirname(file_name)
+    levels = []
+    for name in os.listdir(directory or '.'):
+        level = name[len(prefix):-4]
+        if name.startswith(prefix) and name.endswith('.pyr') and level.isdigit():
+            levels.append(int(level))
+    if not levels:
+        raise RuntimeError('No pyramid files of %s' %file_name)
+
+    levels.sort()
+    for level in levels:
+        name = pyramid_file(file_name, level)
+        f = open(name, 'rb')
+        head = f.read(1<<16)
+        size = os.path.getsize(name)
+        #number of lines estimated from the length of the first lines
+        lines = size*head.count(b'\n')/float(len(head) or 1)
+        if lines <= max_points or level == levels[-1]:
+            text = head + f.read()
+            f.close()
+            return level, parse_range(text, 0, len(text), delimiter=delimiter)
+        f.close()
+
+
+def read_time_range(index_file, t0, t1, columns=None, time_column=None,
+                    delimiter='\t'):
+    '''
+    Returns rows written between times t0 and t1 by Data in the rotating
+    mode. index_file is the file_name.idx of the Data. Times are seconds
+    since epoch or strings accepted by meas_catalog.to_epoch.
+    Only the shards and their parts between index entries around t0
+    and t1 are read, so the result contains rows of up to index_interval
+    before t0 and after t1. If time_column (index of column with the time
+    of the row) is given, only rows with t0 <= time <= t1 are returned.
+    '''
+    from .meas_catalog import to_epoch
+    t0, t1 = to_epoch(t0), to_epoch(t1)
+    if not isinstance(delimiter, bytes): delimiter = delimiter.encode('latin1')
+
+    entries = []
+    f = open(index_file)
+    for line in f:
+        if line.strip():
+            t, shard, offset = line.split('\t')
+            entries.append((float(t), shard, int(offset)))
+    f.close()
+    if not entries:
+        return np.zeros((0, len(columns) if columns is not None else 0))
+
+    times = [e[0] for e in entries]
+    i0 = max(bisect.bisect_right(times, t0) - 1, 0)
+    i1 = bisect.bisect_right(times, t1)     # first entry after t1
+
+    shards = []
+    for e in entries[i0:]:
+        if not e[1] in shards: shards.append(e[1])
+    if i1 < len(entries):
+        shards = shards[:shards.index(entries[i1][1]) + 1]
+
+    directory = os.path.dirname(index_file)
+    blocks = []
+    for shard in shards:
+        start = entries[i0][2] if shard == entries[i0][1] else 0
+        stop = entries[i1][2] if i1 < len(entries) and shard == entries[i1][1] else None
+        f = open(os.path.join(directory, shard), 'rb')
+        size = os.fstat(f.fileno()).st_size
+        if stop is None: stop = size
+        if stop > start:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if buf[:2] == _GZIP_MAGIC:
+                text = _decompress_frames(buf[start:stop], lambda: zlib.decompressobj(31))
+            elif buf[:6] == _XZ_MAGIC:
+                import lzma
+                text = _decompress_frames(buf[start:stop], lzma.LZMADecompressor)
+            else:
+                text = None
+            if text is None:
+                blocks.append(parse_range(buf, start, stop, None, delimiter))
+            else:
+                blocks.append(parse_range(text, 0, len(text), None, delimiter))
+            buf.close()
+        f.close()
+
+    blocks = [b for b in blocks if b.size]
+    if not blocks:
+        return np.zeros((0, len(columns) if columns is not None else 0))
+    data = np.concatenate(blocks)
+    if time_column is not None:
+        data = data[(data[:, time_column] >= t0) & (data[:, time_column] <= t1)]
+    if columns is not None:
+        data = data[:, columns]
+    return data
@@ -1,5 +1,6 @@
+import time
+import numpy as np
 import matplotlib.pyplot as plt
-from scipy.stats import chisquare
 from scipy.optimize import leastsq
 '''
 Functions for fitting lorentzian peaks
@@ -22,17 +23,369 @@ def lorentz(p,x):
     A,B,xc,offs = p
     return A/(1+((x-xc)/B)**2)+offs
 
-def fit_lorentz(x_array, y_array, p0, chi_out=False):
+def chisquare(y_array, y_fit):
+    '''
+    Pearson's chi square of data y_array and fit y_fit along the last
+    axis (statistic of scipy.stats.chisquare, which in new scipy versions
+    rejects data with sum different from the sum of the fit).
+    '''
+    return ((y_array-y_fit)**2/y_fit).sum(-1)
+
+def lorentz_jac(p,x):
+    '''
+    Derivatives of lorentz(p,x) by A, B, xc, offs (rows of the returned
+    array, i.e. column-major Jacobian).
+    '''
+    A,B,xc,offs = p
+    u = (x-xc)/B
+    d = 1/(1+u**2)
+    J = np.empty((4, len(u)))
+    J[0] = d
+    J[2] = 2*A/B*u*d**2
+    J[1] = J[2]*u
+    J[3] = 1
+    return J
+
+def lorentz_err_jac(p,y,x):
+    '''
+    Jacobian of lorentz_err for leastsq (Dfun with col_deriv=1).
+    '''
+    return -lorentz_jac(p,x)
+
+def fit_lorentz(x_array, y_array, p0, chi_out=False, jac=True,
+                ftol=1.49012e-8, xtol=1.49012e-8, maxfev=0, nfev_out=False):
     '''
     p0 = [A, B, xc, offs]
     Q = xc/(2*B)
     y = A/(1+((x-xc)/B)**2)+offs
+
+    jac - use analytic Jacobian (False - estimated by leastsq from
+    differences, 5 evaluations of lorentz_err per step)
+    ftol, xtol, maxfev - tolerances and maximal number of evaluations
+    of leastsq (maxfev=0 - leastsq default)
+    nfev_out - number of evaluations of lorentz_err and of the analytic
+    Jacobian (jac=True) is returned as the last item (evaluations of the
+    estimated Jacobian are included in those of lorentz_err)
     '''
-    pfit, suc = leastsq(lorentz_err, p0, args=(y_array, x_array))
-    chi = chisquare(y_array, lorentz(pfit, x_array))[0]
+    pfit, cov, info, msg, ier = leastsq(
+        lorentz_err, p0, args=(y_array, x_array),
+        Dfun=lorentz_err_jac if jac else None, col_deriv=1,
+        ftol=ftol, xtol=xtol, maxfev=maxfev, full_output=True)
     pfit[1] = abs(pfit[1])      # positive bandwidth
-    if chi_out: return pfit, chi
-    
+    ret = (pfit,)
+    if chi_out: ret += (chisquare(y_array, lorentz(pfit, x_array)),)
+    if nfev_out: ret += (info['nfev'] + info.get('njev', 0),)
+    if len(ret) == 1: return pfit
+
+    return ret
+
+def fit_lorentz_batch(x_array, y_arrays, p0, max_iter=200, ftol=1.49012e-8,
+                      xtol=1.49012e-8, region=None):
+    '''
+    Fits many traces at once by Levenberg-Marquardt vectorized over the
+    traces.
+    x_array - x of all traces (1D) or of each trace (2D, as y_arrays)
+    y_arrays - 2D array, one trace in each row
+    p0 - [A, B, xc, offs] for all traces or 2D array with row for each
+    trace
+    Fit of a trace stops when relative decrease of the sum of squares is
+    below ftol or relative change of parameters is below xtol.
+    region - only points closer than region*B of p0 to xc of p0 are
+    fitted (as in PeakTracker), the same number of points in all traces
+    (the widest region), None - whole traces
+    Returns (pfit, chi, converged): array of parameters (row for each
+    trace), vector of chi square (as fit_lorentz, of the fitted points)
+    and boolean vector of converged fits (False - max_iter reached).
+    Speedup to fit_lorentz in a loop is large only for short traces
+    (about 8 at 50 points, 3.5 at 200 points, 1.4 at 1600 points): the
+    loop is slowed by python calls, which do not grow with the length.
+    Use region for long traces of narrow peaks.
+    '''
+    y = np.atleast_2d(np.asarray(y_arrays, dtype=float))
+    n, m = y.shape
+    x = np.asarray(x_array, dtype=float)
+    pfit = np.zeros((n, 4)) + np.asarray(p0, dtype=float)
+    converged = np.zeros(n, dtype=bool)
+    if region is not None:
+        half = region*np.abs(pfit[:,1:2])
+        lo = (x < pfit[:,2:3] - half).sum(1)
+        hi = (x <= pfit[:,2:3] + half).sum(1)
+        m = min(m, max((hi - lo).max(), 8))
+        lo = np.clip(lo, 0, y.shape[1] - m)
+        rows = np.arange(n)[:,None]
+        columns = lo[:,None] + np.arange(m)
+        y = y[rows, columns]
+        x = x[columns] if x.ndim == 1 else x[rows, columns]
+    shared_x = x.ndim == 1
+
+    #Rows of K for each trace: d, Jacobian columns of B and xc, 1 (column
+    #of offs), residuals; K*K.T gives J.T*J, J.T*r and r*r at once.
+    #Arrays of the working traces are shrunk only when some fits stop.
+    K = np.empty((n, 5, m))
+    K_new = np.empty((n, 5, m))
+    K[:,3] = K_new[:,3] = 1
+    u = np.empty((n, m))
+    u_new = np.empty((n, m))
+
+    def model_terms(p, x, y, u, K):
+        '''
+        Fills u = (x-xc)/B, d = 1/(1+u**2) and residuals y - A*d - offs
+        of the traces with parameters p, computed in place.
+        '''
+        A, B, xc, offs = [c[:,None] for c in p.T]
+        d, r = K[:,0], K[:,4]
+        np.subtract(x, xc, out=u)
+        u *= 1/B
+        np.multiply(u, u, out=d)
+        d += 1
+        np.reciprocal(d, out=d)
+        np.multiply(A, d, out=r)
+        r += offs
+        np.subtract(y, r, out=r)
+
+    traces = np.arange(n)       # traces of the rows of the working arrays
+    p = pfit.copy()
+    ya, xa = y, x
+    model_terms(p, xa, ya, u, K)
+    cost = np.einsum('ij,ij->i', K[:,4], K[:,4])
+    lam = np.zeros(n) + 1e-3
+    live = np.ones(n, dtype=bool)
+    eye = np.eye(4)
+    for iteration in range(max_iter):
+        if not live.any():
+            break
+        #Jacobian columns of B and xc
+        d, J_B, J_xc = K[:,0], K[:,1], K[:,2]
+        np.multiply(d, d, out=J_xc)
+        J_xc *= u
+        J_xc *= (2*p[:,0]/p[:,1])[:,None]
+        np.multiply(J_xc, u, out=J_B)
+        KK = np.einsum('nim,njm->nij', K, K)
+        JTJ = KK[:,:4,:4]
+        g = KK[:,:4,4]
+
+        diag = JTJ[:,eye.astype(bool)]
+        diag = np.maximum(diag, 1e-30*diag.max(1)[:,None] + 1e-300)
+        M = JTJ + (lam[:,None]*diag)[:,:,None]*eye
+        dp = np.linalg.solve(M, g[:,:,None])[:,:,0]
+        new_p = p + dp
+        model_terms(new_p, xa, ya, u_new, K_new)
+        new_cost = np.einsum('ij,ij->i', K_new[:,4], K_new[:,4])
+
+        better = new_cost < cost
+        f_small = better & ((cost - new_cost) <= ftol*cost)
+        x_small = better & (np.abs(dp) <= xtol*(np.abs(p) + xtol)).all(1)
+        #no improvement possible (step below numeric precision)
+        stalled = ~better & ((lam > 1e16) |
+            (np.abs(dp) <= 1e-15*np.abs(p)).all(1))
+        #rows of the minority (usually rejected steps) are copied,
+        #buffers of the new values are swapped with the old ones
+        rows = np.nonzero(better)[0]
+        if 2*len(rows) > len(better):
+            rows = np.nonzero(~better)[0]
+            p, new_p = new_p, p
+            u, u_new = u_new, u
+            K, K_new = K_new, K
+            cost, new_cost = new_cost, cost
+        p[rows] = new_p[rows]
+        u[rows] = u_new[rows]
+        K[rows] = K_new[rows]
+        cost[rows] = new_cost[rows]
+        lam[better] /= 10
+        lam[~better] *= 10
+
+        done = live & (f_small | x_small | stalled)
+        if done.any():
+            pfit[traces[done]] = p[done]
+            converged[traces[done]] = True
+            live &= ~done
+            #finished fits are computed further (results ignored) until
+            #a quarter of the rows can be dropped
+            if live.sum() <= 0.75*len(live):
+                traces = traces[live]
+                p, cost, lam = p[live], cost[live], lam[live]
+                u, K = u[live], K[live]
+                u_new, K_new = u_new[:len(traces)], K_new[:len(traces)]
+                ya = y[traces]
+                if not shared_x: xa = x[traces]
+                live = np.ones(len(traces), dtype=bool)
+    pfit[traces[live]] = p[live]    # max_iter reached
+
+    pfit[:,1] = abs(pfit[:,1])  # positive bandwidth
+    chi = chisquare(y, lorentz(pfit.T[:,:,None], x))
+    return pfit, chi, converged
+
+def _smooth(y, smooth):
+    '''
+    Moving average of smooth points with reflected ends, (smooth-1)//2
+    points on the left and smooth//2 on the right keep the length for
+    even smooth too.
+    '''
+    if not (smooth > 1 and len(y) > smooth):
+        return y
+    left, right = (smooth-1)//2, smooth//2
+    y_pad = np.concatenate((y[left:0:-1], y, y[-2:-right-2:-1]))
+    return np.convolve(y_pad, np.ones(smooth)/smooth, mode='valid')
+
+def estimate_lorentz(x_array, y_array, smooth=5):
+    '''
+    Estimates p = [A, B, xc, offs] of a peak without iterations: maximum
+    of the trace smoothed by moving average of smooth points, half
+    maximum (-3 dB) crossings interpolated on both sides of the maximum
+    and linear least squares fit of 1/(y-offs), which is a quadratic
+    function of x for lorentzian, in the region above half maximum.
+    Offset is mean of the lowest 10 % of the smoothed trace.
+    Usable as p0 of fit_lorentz instead of marker search of the analyzer.
+    '''
+    x = np.asarray(x_array, dtype=float)
+    y = np.asarray(y_array, dtype=float)
+    ys = _smooth(y, smooth)
+    offs = np.sort(ys)[:max(1, len(ys)//10)].mean()
+    i = int(np.argmax(ys))
+    A = ys[i] - offs
+    xc = x[i]
+    half = offs + A/2.
+
+    #-3 dB crossings, linear interpolation between neighbouring points
+    crossings = []
+    below = np.nonzero(ys[:i] < half)[0]
+    if len(below):
+        j = below[-1]
+        crossings.append(x[j] + (half-ys[j])*(x[j+1]-x[j])/(ys[j+1]-ys[j]))
+    below = np.nonzero(ys[i:] < half)[0]
+    if len(below):
+        j = i + below[0]
+        crossings.append(x[j-1] + (half-ys[j-1])*(x[j]-x[j-1])/(ys[j]-ys[j-1]))
+    if len(crossings) == 2:
+        B = (crossings[1]-crossings[0])/2.
+    elif crossings:
+        B = abs(crossings[0]-xc)
+    else:
+        B = (x[-1]-x[0])/2.
+
+    #1/(y-offs) = (1+((x-xc)/B)**2)/A = a*t**2 + b*t + c, t = (x-x[i])/B
+    #(scaled x, quadratic fit of raw x is ill-conditioned for high Q)
+    z = y - offs
+    t = (x - xc)/B
+    region = (np.abs(t) <= 2) & (z > A/4.)
+    if region.sum() >= 4:
+        a, b, c = np.polyfit(t[region], 1/z[region], 2, w=z[region]**2)
+        if a > 0:
+            t_fit = -b/(2*a)
+            A_fit = 1/(c - a*t_fit**2)
+            if A_fit > 0 and abs(t_fit) < 2:
+                xc, A = xc + t_fit*B, A_fit
+                B = B/np.sqrt(a*A)
+    return np.array([A, abs(B), xc, offs])
+
+def lorentz_multi(p,x):
+    '''
+    Sum of lorentzian peaks, p = [A1, B1, xc1, A2, B2, xc2, ..., offs]
+    y = sum(Ai/(1+((x-xci)/Bi)**2))+offs
+    '''
+    A,B,xc = np.reshape(p[:-1], (-1, 3)).T[:,:,None]
+    return (A/(1+((x-xc)/B)**2)).sum(0) + p[-1]
+
+def find_peaks_lorentz(x_array, y_array, max_peaks=None, threshold=0.1,
+                       snr=5., smooth=5):
+    '''
+    Finds peaks in the trace and estimates their parameters. Peaks are
+    local maxima of the trace smoothed by moving average of smooth points
+    higher than threshold times the highest peak and snr times the noise
+    (from differences of neighbouring points) above the offset. Each peak
+    is estimated by estimate_lorentz in the part of the trace between
+    the neighbouring peaks, peaks closer than bandwidth to a higher peak
+    are dropped.
+    Returns array with rows [A, B, xc, offs] sorted by xc (at most
+    max_peaks highest peaks).
+    '''
+    x = np.asarray(x_array, dtype=float)
+    y = np.asarray(y_array, dtype=float)
+    ys = _smooth(y, smooth)
+    offs = np.sort(ys)[:max(1, len(ys)//10)].mean()
+    noise = np.median(np.abs(np.diff(y)))/0.954   # MAD of differences -> sigma
+    height = ys - offs
+    #rounding errors of the average are not peaks (trace without noise)
+    level = max(threshold*height.max(), snr*noise/np.sqrt(smooth),
+                1e-12*np.abs(ys).max())
+
+    #local maxima in window of smooth points on both sides
+    w = max(smooth, 1)
+    padded = np.concatenate((np.zeros(w) - np.inf, ys, np.zeros(w) - np.inf))
+    window_max = np.max([padded[i:i+len(ys)] for i in range(2*w+1)], axis=0)
+    candidates = np.nonzero((ys == window_max) & (height > level))[0]
+    if not level > 0:
+        candidates = candidates[:0]     # zero trace
+    candidates = candidates[np.argsort(-height[candidates])]
+
+    peaks = []
+    for i in candidates:
+        #part of the trace up to the neighbouring higher peaks
+        lower = [j for j, p in peaks if j < i]
+        upper = [j for j, p in peaks if j > i]
+        start = (max(lower) + i)//2 if lower else 0
+        stop = (min(upper) + i)//2 + 1 if upper else len(x)
+        if stop - start < 5:
+            continue
+        p = estimate_lorentz(x[start:stop], y[start:stop], smooth)
+        p[3] = offs
+        if not x[start] <= p[2] <= x[stop-1]:
+            p[2] = x[i]
+        if any(abs(q[2] - p[2]) < q[1] for j, q in peaks):
+            continue
+        peaks.append((i, p))
+        if max_peaks is not None and len(peaks) >= max_peaks:
+            break
+    peaks = np.array([p for i, p in peaks]).reshape(-1, 4)
+    return peaks[np.argsort(peaks[:,2])]
+
+def fit_lorentz_multi(x_array, y_array, p0=None, max_peaks=None, window=20.,
+                      chi_out=False, sparse=True, **kwargs):
+    '''
+    Fits sum of lorentzian peaks with common offset.
+    p0 - array with rows [A, B, xc, offs] (offs of the first row is used),
+    found by find_peaks_lorentz(x_array, y_array, max_peaks) if None
+    window - peak i is assumed to change only points closer than
+    window*Bi to its center (sparsity of the Jacobian)
+    sparse - use the sparsity, number of evaluations of the model per
+    Jacobian does not grow with the number of peaks (False - dense
+    Jacobian with an evaluation per parameter)
+    kwargs - passed to scipy.optimize.least_squares (scipy >= 0.17;
+    ftol, xtol, max_nfev)
+    Returns array with rows [A, B, xc, offs] (each row is the parameter
+    vector of lorentz/fit_lorentz of one peak) sorted by xc, and chi
+    square if chi_out.
+    '''
+    from scipy.optimize import least_squares
+    from scipy.sparse import lil_matrix
+
+    x = np.asarray(x_array, dtype=float)
+    y = np.asarray(y_array, dtype=float)
+    if p0 is None:
+        p0 = find_peaks_lorentz(x, y, max_peaks)
+    p0 = np.atleast_2d(np.asarray(p0, dtype=float))
+    if not len(p0):
+        raise RuntimeError('No peaks found')
+    n = len(p0)
+    p_start = np.r_[p0[:,:3].ravel(), p0[0,3]]
+
+    if sparse:
+        pattern = lil_matrix((len(x), 3*n+1), dtype=int)
+        for k, (A, B, xc, offs) in enumerate(p0):
+            rows = np.nonzero(np.abs(x-xc) <= window*abs(B))[0]
+            for c in range(3):
+                pattern[rows, 3*k+c] = 1
+        pattern[:, 3*n] = 1
+        kwargs.setdefault('jac_sparsity', pattern)
+        kwargs.setdefault('tr_solver', 'lsmr')
+
+    res = least_squares(lambda p: lorentz_multi(p, x) - y, p_start,
+                        x_scale='jac', **kwargs)
+    pfit = np.column_stack((res.x[:-1].reshape(n, 3), np.zeros(n) + res.x[-1]))
+    pfit[:,1] = abs(pfit[:,1])      # positive bandwidth
+    pfit = pfit[np.argsort(pfit[:,2])]
+    if chi_out:
+        return pfit, chisquare(y, lorentz_multi(np.r_[pfit[:,:3].ravel(), res.x[-1]], x))
     return pfit
 
 def plot_fit_and_data(x_array, y_array, pfit):
@@ -48,6 +401,169 @@ def find_fit_region(f1, f2, nf, f_c, fratio):
     if stop_point > nf: stop_point = nf
     return int(start_point), int(stop_point)
 
+class PeakTracker(object):
+    '''
+    Fits a peak in consecutive traces of a sweep (power, field,
+    temperature...). Every fit is started from the last fitted parameters
+    with center predicted from the previous centers (linear extrapolation
+    or Kalman filter with constant velocity model) and uses only points
+    around the predicted center. If the fit fails or its residuals jump,
+    the trace is fitted again from estimate_lorentz of the whole trace.
+
+    Usage:
+
+    tracker = PeakTracker(region=5)
+    for power in powers:
+        f, amp = measure(power)
+        p = tracker.fit(f, amp, step=power)
+    print(tracker.stats())
+    '''
+    def __init__(self, region=5.0, predictor='linear', jump=3.0,
+                 process_noise=0.1, measurement_noise=0.01, **fit_kwargs):
+        '''
+        region - half-width of the fitted region in bandwidths B around the
+        predicted center (None - whole trace)
+        predictor - 'linear' or 'kalman' prediction of the center
+        jump - fallback to full estimate when rms of residuals is larger
+        than jump times its running average
+        process_noise, measurement_noise - Kalman filter noise of center
+        velocity and of fitted center, in units of B
+        fit_kwargs - passed to fit_lorentz (ftol, xtol, maxfev)
+        '''
+        if not predictor in ('linear', 'kalman'):
+            raise RuntimeError('Unknown predictor %s, use "linear" or "kalman"' %predictor)
+        self.region = region
+        self.predictor = predictor
+        self.jump = jump
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.fit_kwargs = fit_kwargs
+        self.reset()
+
+    def __repr__(self):
+        return '<PeakTracker %i fits>' %self.fits
+
+    def reset(self):
+        '''
+        Forgets the history, next fit starts from full estimate.
+        '''
+        self.p = None
+        self.centers = []           # (step, xc) of the fits
+        self.rms = None             # running average of rms of residuals
+        self._kalman = None         # (state [xc, velocity], covariance, step)
+        self.fits = 0
+        self.fallbacks = 0
+        self.fit_time = 0.0
+        self.cold_nfev = []
+        self.warm_nfev = []
+
+    def predict(self, step=None):
+        '''
+        Returns predicted center of the next trace at sweep value step
+        (index of the trace if None).
+        '''
+        if step is None: step = len(self.centers)
+        if self.predictor == 'kalman' and self._kalman is not None:
+            state, cov, last_step = self._kalman
+            return state[0] + state[1]*(step - last_step)
+        if len(self.centers) >= 2:
+            (s1, x1), (s2, x2) = self.centers[-2:]
+            if not s2 == s1:
+                return x2 + (x2-x1)*(step-s2)/float(s2-s1)
+        return self.p[2]
+
+    def _kalman_update(self, step, xc):
+        B = self.p[1]
+        R = (self.measurement_noise*B)**2
+        if self._kalman is None:
+            self._kalman = (np.array([xc, 0.]), np.diag([R, (self.process_noise*B)**2]), step)
+            return
+        state, cov, last_step = self._kalman
+        dt = float(step - last_step) or 1.
+        F = np.array([[1., dt], [0., 1.]])
+        q = (self.process_noise*B)**2
+        Q = q*np.array([[dt**3/3., dt**2/2.], [dt**2/2., dt]])
+        state = F.dot(state)
+        cov = F.dot(cov).dot(F.T) + Q
+        gain = cov[:,0]/(cov[0,0] + R)
+        state = state + gain*(xc - state[0])
+        cov = cov - np.outer(gain, cov[0])
+        self._kalman = (state, cov, step)
+
+    def _region(self, x, xc, B):
+        if self.region is None:
+            return slice(None)
+        inside = np.nonzero(np.abs(x-xc) <= self.region*B)[0]
+        if len(inside) < 8:
+            return slice(None)
+        return slice(inside[0], inside[-1]+1)
+
+    def _fit(self, x, y, p0):
+        '''
+        Returns (pfit, rms of residuals, nfev) of fit in the region around
+        center of p0. Residuals are evaluated on the whole trace, so a
+        peak which moved out of the region makes them jump.
+        '''
+        r = self._region(x, p0[2], abs(p0[1]))
+        pfit, nfev = fit_lorentz(x[r], y[r], p0, nfev_out=True, **self.fit_kwargs)
+        rms = np.sqrt(np.mean(lorentz_err(pfit, y, x)**2))
+        return pfit, rms, nfev
+
+    def fit(self, x_array, y_array, step=None):
+        '''
+        Fits the trace, returns p = [A, B, xc, offs]. step - value of the
+        swept quantity (index of the trace if None), used by prediction.
+        '''
+        t0 = time.time()
+        x = np.asarray(x_array, dtype=float)
+        y = np.asarray(y_array, dtype=float)
+        if step is None: step = len(self.centers)
+
+        pfit = None
+        if self.p is not None:
+            p0 = self.p.copy()
+            p0[2] = self.predict(step)
+            pfit, rms, nfev = self._fit(x, y, p0)
+            if (not x.min() <= pfit[2] <= x.max() or not np.isfinite(rms) or
+                    rms > self.jump*self.rms):
+                self.fallbacks += 1
+                pfit = None
+            else:
+                self.warm_nfev.append(nfev)
+        if pfit is None:
+            pfit, rms, nfev = self._fit(x, y, estimate_lorentz(x, y))
+            self.cold_nfev.append(nfev)
+            self.centers = []
+            self._kalman = None
+            self.rms = rms
+
+        self.p = pfit
+        self.centers.append((step, pfit[2]))
+        if self.predictor == 'kalman':
+            self._kalman_update(step, pfit[2])
+        self.rms = 0.8*self.rms + 0.2*rms
+        self.fits += 1
+        self.fit_time += time.time() - t0
+        return pfit
+
+    def stats(self):
+        '''
+        Returns dictionary with number of fits, fallbacks to full estimate,
+        fits per second, mean number of evaluations of warm and cold
+        (from estimate) fits and total evaluations saved by warm starts
+        (compared with the mean of cold fits).
+        '''
+        cold = float(np.mean(self.cold_nfev)) if self.cold_nfev else 0.0
+        warm = float(np.mean(self.warm_nfev)) if self.warm_nfev else 0.0
+        return {
+            'fits': self.fits,
+            'fallbacks': self.fallbacks,
+            'fits_per_second': self.fits/self.fit_time if self.fit_time else 0.0,
+            'cold_nfev': cold,
+            'warm_nfev': warm,
+            'nfev_saved': (cold - warm)*len(self.warm_nfev),
+            }
+
 # test
 def load_dummy_data():
     import numpy as np
@@ -63,3 +579,127 @@ def load_dummy_data():
     pfit = fit_lorentz(x, y_r, p_guess)
 
     plot_fit_and_data(x,y_r,pfit)
+
+def benchmark_estimate(traces=200, points=1601, noise=0.05):
+    '''
+    Relative errors of estimate_lorentz and of fit_lorentz started from it
+    on noisy traces.
+    '''
+    x = np.linspace(1e9, 2e9, points)
+    errors = []
+    for k in range(traces):
+        p_true = np.array([np.random.uniform(0.5, 1.5), np.random.uniform(2e7, 1e8),
+                           np.random.uniform(1.3e9, 1.7e9), 0.01])
+        y = lorentz(p_true, x) + noise*np.random.randn(points)
+        p0 = estimate_lorentz(x, y)
+        pfit = fit_lorentz(x, y, p0)
+        errors.append(np.abs(np.r_[p0[:3], pfit[:3]] - np.r_[p_true[:3], p_true[:3]])/
+                      np.r_[p_true[:3], p_true[:3]])
+    errors = np.median(errors, axis=0)
+    print('median relative error of estimate A %.3g, B %.3g, xc %.3g' %tuple(errors[:3]))
+    print('median relative error of fit      A %.3g, B %.3g, xc %.3g' %tuple(errors[3:]))
+
+def benchmark_tracker(traces=500, points=1601, predictor='linear'):
+    '''
+    Tracks a peak drifting over a sweep by PeakTracker and compares with
+    fits started from estimate_lorentz of every trace.
+    '''
+    x = np.linspace(1e9, 2e9, points)
+    centers = 1.5e9 + 2e8*np.sin(np.linspace(0, 3, traces))
+    y = [lorentz([1, 1e7, xc, 0.01], x) + 0.02*np.random.randn(points) for xc in centers]
+
+    tracker = PeakTracker(predictor=predictor)
+    for i, y_t in enumerate(y):
+        tracker.fit(x, y_t, step=i)
+    print(tracker.stats())
+
+    t0 = time.time()
+    nfev = [fit_lorentz(x, y_t, estimate_lorentz(x, y_t), nfev_out=True)[1] for y_t in y]
+    print('cold fits: %.1f fits/s, %.1f evaluations per fit' %(
+        traces/(time.time()-t0), np.mean(nfev)))
+
+def benchmark_multi(numbers_of_peaks=(5, 10, 20), points_per_peak=200):
+    '''
+    Fits traces with many peaks by fit_lorentz_multi with sparse and
+    dense Jacobian.
+    '''
+    for n in numbers_of_peaks:
+        x = np.linspace(1e9, 2e9, n*points_per_peak)
+        centers = np.linspace(1e9, 2e9, n+2)[1:-1] + np.random.uniform(-1e7, 1e7, n)
+        p_true = np.r_[np.column_stack((
+            np.random.uniform(0.5, 1.5, n),
+            np.random.uniform(1e6, 3e6, n), centers)).ravel(), 0.01]
+        y = lorentz_multi(p_true, x) + 0.01*np.random.randn(len(x))
+        p0 = find_peaks_lorentz(x, y)
+        for sparse in (True, False):
+            t = []
+            for repeat in range(3):
+                t0 = time.time()
+                pfit = fit_lorentz_multi(x, y, p0, sparse=sparse)
+                t.append(time.time() - t0)
+            t = min(t)
+            error = np.abs(pfit[:,2] - np.sort(centers)).max() if len(pfit) == n else np.nan
+            print('%i peaks (%i found), sparse=%s: %.3f s, max center error %.3g' %(
+                n, len(p0), sparse, t, error))
+
+def benchmark_jacobian(fits=200, points=201):
+    '''
+    Compares time and number of evaluations of fit_lorentz with analytic
+    and estimated Jacobian.
+    '''
+    import time
+
+    x = np.linspace(1e9, 2e9, points)
+    p_dummy = [1, 1e8, 1.5e9, 0.001]
+    y = lorentz(p_dummy, x)*(1 + 0.02*np.random.randn(fits, points))
+    p_guess = [0.8, 2e8, 1.45e9, 0]
+    for jac in (False, True):
+        t0 = time.time()
+        nfev = [fit_lorentz(x, y_t, p_guess, jac=jac, nfev_out=True)[1] for y_t in y]
+        print('jac=%s: %.3f ms per fit, %.1f evaluations (function and Jacobian) per fit' %(
+            jac, (time.time()-t0)/fits*1e3, np.mean(nfev)))
+
+def benchmark_batch(traces=1000, points=201, region=None):
+    '''
+    Compares fit_lorentz_batch with fit_lorentz called in a loop.
+    With region narrow peaks (bandwidth 1-3 % of the span) are fitted
+    from p0 of the maximum of each trace, the loop fits the whole traces
+    and, for comparison, the same regions as the batch.
+    '''
+    import time
+
+    x = np.linspace(1e9, 2e9, points)
+    if region is None:
+        B = np.random.uniform(5e7, 1.5e8, traces)
+    else:
+        B = np.random.uniform(1e7, 3e7, traces)
+    p_true = np.column_stack((
+        np.random.uniform(0.5, 1.5, traces),
+        B,
+        np.random.uniform(1.4e9, 1.6e9, traces),
+        np.zeros(traces) + 0.001))
+    y = lorentz(p_true.T[:,:,None], x)*(1 + 0.02*np.random.randn(traces, points))
+    if region is None:
+        p_guess = np.zeros((traces, 4)) + [1, 1e8, 1.5e9, 0]
+    else:
+        p_guess = np.column_stack((
+            y.max(1), np.zeros(traces) + 2e7, x[np.argmax(y, 1)], np.zeros(traces)))
+
+    t0 = time.time()
+    p_loop = np.array([fit_lorentz(x, y_t, p) for y_t, p in zip(y, p_guess)])
+    t1 = time.time()
+    p_batch, chi, converged = fit_lorentz_batch(x, y, p_guess, region=region)
+    t_batch = time.time() - t1
+
+    print('loop %.3f s, batch %.3f s, speedup %.1f, converged %i/%i' %(
+        t1-t0, t_batch, (t1-t0)/t_batch, converged.sum(), traces))
+    print('max relative difference of parameters %g' %(
+        np.abs(p_batch - p_loop)/np.abs(p_loop))[:,:3].max())
+    if region is not None:
+        t0 = time.time()
+        for y_t, p in zip(y, p_guess):
+            r = np.abs(x - p[2]) <= region*p[1]
+            fit_lorentz(x[r], y_t[r], p)
+        t1 = time.time()
+        print('loop of the same regions %.3f s, speedup %.1f' %(
+            t1-t0, (t1-t0)/t_batch))
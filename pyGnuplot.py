@@ -1,4 +1,12 @@
 import os
+import sys
+import time
+import threading
+import subprocess
+import numpy as np
+
+from .meas_data import replace_file
+from .meas_reader import parse_range
 '''
 Module for plotting measurement data during measurement.
 
@@ -8,10 +16,291 @@ e.g. in first iteration of the measurement loop). GNUPLOT then every time
 interval specified by parameter "pause" rereads itself, replots data and
 save current figure if "savefig" is  set to True.
 
+Pipe mode (pipe=True): start_plot() starts gnuplot as a subprocess and keeps
+its standard input open. A thread checks every "pause" seconds the data files
+(modification time and size) and sends the plot commands to gnuplot only if
+some file changed. The figure is saved at most every "png_interval" seconds.
+update() can be called instead from the measurement loop (start_plot(watch=False)),
+stop_plot() closes gnuplot.
+
+Adaptive refresh (pipe mode, refresh=True or RefreshScheduler): instead of the
+fixed "pause" the data files are checked in intervals given by RefreshScheduler.
+Every replot waits until gnuplot finishes drawing, the interval is at least
+the drawing time divided by the CPU budget (0.25 - gnuplot draws at most
+25 % of time) and it grows while the data do not change.
+
+Decimation (decimate=N): gnuplot plots min/max decimated copies of the data
+files (.dec files, 2*N points per line) instead of the whole files. The copies
+are updated by update(): in pipe mode by the watching thread, without pipe mode
+by a thread started by start_plot() which checks the data files every "pause"
+seconds (with start_plot(watch=False) update() has to be called from the
+measurement loop, otherwise gnuplot rereads the old copies).
+
 Matus Rehak
 ...
 Last update: 14.12.2015
 '''
+# gnuplot executable which reads commands from standard input
+# (pgnuplot.exe for gnuplot 4.6 on Windows)
+GNUPLOT = 'gnuplot'
+
+def _gnuplot_path(path):
+    return path.replace('\\','\\\\')
+
+class _GnuplotProcess(object):
+    '''
+    gnuplot running as subprocess, commands are written to its stdin.
+    With capture=True messages of gnuplot (stderr) are read by sync().
+    '''
+    def __init__(self, gnuplot=GNUPLOT, capture=False):
+        self.process = subprocess.Popen(
+            [gnuplot], stdin=subprocess.PIPE,
+            stderr=subprocess.PIPE if capture else None)
+        self._syncs = 0
+
+    def send(self, line_list):
+        text = '\n'.join(line_list)+'\n'
+        if not isinstance(text, bytes): text = text.encode('utf-8')
+        self.process.stdin.write(text)
+        self.process.stdin.flush()
+
+    def send_data(self, data):
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def sync(self):
+        '''
+        Waits until gnuplot executes all sent commands (capture mode only).
+        Returns list of messages printed by gnuplot meanwhile.
+        '''
+        self._syncs += 1
+        marker = '__sync_%i__' %self._syncs
+        self.send(['print "%s"' %marker])
+        messages = []
+        while True:
+            line = self.process.stderr.readline()
+            if not line:
+                raise RuntimeError('gnuplot finished: %s' %''.join(messages))
+            line = line.decode('utf-8', 'replace').rstrip()
+            if line == marker:
+                return messages
+            messages.append(line)
+
+    def close(self):
+        try:
+            self.send(['exit'])
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass                # gnuplot already finished
+        self.process.wait()
+
+class RefreshScheduler(object):
+    '''
+    Intervals between checks of the data files in pipe mode of PyGnuplot.
+    '''
+    def __init__(self, min_interval=0.1, max_interval=5.0, cpu_budget=0.25,
+                 backoff=1.5):
+        '''
+        min_interval, max_interval - limits of the interval [s]
+        cpu_budget - maximal fraction of time spent by drawing, the
+        interval after a replot is at least drawing time / cpu_budget
+        backoff - the interval is multiplied by backoff after every check
+        without change of the data (up to max_interval)
+        '''
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.cpu_budget = cpu_budget
+        self.backoff = backoff
+        self.interval = min_interval
+        self.render_time = None     # moving average of drawing time [s]
+        self.redraws = 0
+        self.idle_checks = 0
+        self.total_render_time = 0.0
+
+    def __repr__(self):
+        return '<RefreshScheduler interval %.3f s>' %self.interval
+
+    def record(self, redrawn, render_time=0.0):
+        '''
+        Sets the next interval after a check of the data, redrawn - True if
+        the plot was drawn, render_time - time of drawing [s].
+        Returns the next interval.
+        '''
+        if redrawn:
+            self.redraws += 1
+            self.total_render_time += render_time
+            if self.render_time is None:
+                self.render_time = render_time
+            else:
+                self.render_time = 0.7*self.render_time + 0.3*render_time
+            self.interval = self.render_time/self.cpu_budget
+        else:
+            self.idle_checks += 1
+            self.interval *= self.backoff
+        self.interval = min(max(self.interval, self.min_interval), self.max_interval)
+        return self.interval
+
+    def stats(self):
+        '''
+        Returns dictionary with number of redraws, number of checks without
+        change, mean drawing time [s] and the current interval [s].
+        '''
+        return {
+            'redraws': self.redraws,
+            'idle_checks': self.idle_checks,
+            'mean_render_time': self.total_render_time/self.redraws if self.redraws else 0.0,
+            'interval': self.interval,
+            }
+
+def _plot_lines(x, y):
+    '''
+    Returns lists of x and y arrays of the lines of one plot of
+    plot_arrays data: y is an array or a list of arrays (one for each
+    line), x is an array or a list of arrays. Empty y is one empty line.
+    '''
+    if not (len(y) and hasattr(y[0], '__iter__')): y = [y]
+    if not (len(x) and hasattr(x[0], '__iter__')): x = [x]*len(y)
+    return x, y
+
+def minmax_decimate(x, y, bucket_rows):
+    '''
+    Splits x, y (arrays rows*columns, columns are pairs of x and y data)
+    to buckets of bucket_rows rows and returns arrays mins, maxs
+    (buckets*columns*3) with (row, x, y) of minimal and maximal y in each
+    bucket. Incomplete last bucket is ignored, nan values of y are skipped.
+    '''
+    buckets = len(y)//bucket_rows
+    x = x[:buckets*bucket_rows].reshape(buckets, bucket_rows, -1)
+    y = y[:buckets*bucket_rows].reshape(buckets, bucket_rows, -1)
+    nan = np.isnan(y)
+    b = np.arange(buckets)[:,None]
+    c = np.arange(y.shape[2])[None,:]
+    ret = []
+    for fill, arg in ((np.inf, np.argmin), (-np.inf, np.argmax)):
+        i = arg(np.where(nan, fill, y), axis=1)
+        ret.append(np.dstack((b*bucket_rows + i, x[b, i, c], y[b, i, c])))
+    return ret
+
+def _merge_buckets(mins, maxs):
+    '''
+    Merges pairs of neighbouring buckets of minmax_decimate (odd last
+    bucket is kept).
+    '''
+    n = len(mins)//2*2
+    ret = []
+    for a, op in ((mins, np.less_equal), (maxs, np.greater_equal)):
+        pairs = a[:n].reshape(n//2, 2, a.shape[1], 3)
+        first = op(pairs[:,0,:,2], pairs[:,1,:,2]) | np.isnan(pairs[:,1,:,2])
+        ret.append(np.concatenate((
+            np.where(first[:,:,None], pairs[:,0], pairs[:,1]), a[n:])))
+    return ret
+
+class _DecimationCache(object):
+    '''
+    Min/max decimation of (x, y) column pairs of one data file, kept in
+    file data_file.dec with columns x1 y1 x2 y2 ... (one pair for every
+    pair of the plots), two lines for every bucket.
+    '''
+    def __init__(self, data_file, buckets):
+        self.data_file = data_file
+        self.cache_file = data_file + '.dec'
+        self.buckets = buckets
+        self.pairs = []             # (x, y) columns, 0-based
+        self.reset()
+
+    def add_pair(self, x_column, y_column):
+        '''
+        Returns index (0-based) of the pair in the cache file.
+        '''
+        pair = (x_column - 1, y_column - 1)
+        if not pair in self.pairs: self.pairs.append(pair)
+        return self.pairs.index(pair)
+
+    def reset(self):
+        self.offset = 0
+        self.rows = 0
+        self.bucket_rows = 1
+        self.number_of_columns = None
+        self.mins = self.maxs = None
+        self._pending = None
+
+    def update(self):
+        '''
+        Reads rows appended to the data file and rewrites the cache file.
+        Returns True if there were new rows.
+        '''
+        f = open(self.data_file, 'rb')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size < self.offset or self.data_file.endswith('.tmp'):
+                self.reset()
+            f.seek(self.offset)
+            text = f.read(size - self.offset)
+        finally:
+            f.close()
+        text = text[:text.rfind(b'\n') + 1]   # only complete lines
+        self.offset += len(text)
+        if not text.strip() and self.mins is not None:
+            return False
+
+        new = parse_range(text, 0, len(text), delimiter=b' ',
+                          number_of_columns=self.number_of_columns)
+        if len(new):
+            if self.number_of_columns is None:
+                self.number_of_columns = new.shape[1]
+            if self._pending is not None:
+                new = np.concatenate((self._pending, new))
+            self._add_rows(new)
+        self._write()
+        return True
+
+    def _add_rows(self, data):
+        xc = [p[0] for p in self.pairs]
+        yc = [p[1] for p in self.pairs]
+        full = len(data)//self.bucket_rows*self.bucket_rows
+        if full:
+            mins, maxs = minmax_decimate(
+                data[:full, xc], data[:full, yc], self.bucket_rows)
+            mins[:,:,0] += self.rows
+            maxs[:,:,0] += self.rows
+            if self.mins is not None:
+                mins = np.concatenate((self.mins, mins))
+                maxs = np.concatenate((self.maxs, maxs))
+            self.mins, self.maxs = mins, maxs
+            self.rows += full
+        self._pending = data[full:]
+        while self.mins is not None and len(self.mins) > 2*self.buckets:
+            self.mins, self.maxs = _merge_buckets(self.mins, self.maxs)
+            self.bucket_rows *= 2
+
+    def _write(self):
+        mins, maxs = self.mins, self.maxs
+        if self._pending is not None and len(self._pending):
+            xc = [p[0] for p in self.pairs]
+            yc = [p[1] for p in self.pairs]
+            p_mins, p_maxs = minmax_decimate(
+                self._pending[:, xc], self._pending[:, yc], len(self._pending))
+            if mins is None:
+                mins, maxs = p_mins, p_maxs
+            else:
+                mins = np.concatenate((mins, p_mins))
+                maxs = np.concatenate((maxs, p_maxs))
+        if mins is None:
+            points = np.zeros((0, 2*len(self.pairs)))
+        else:
+            #points of each bucket in the order of rows
+            min_first = (mins[:,:,0] <= maxs[:,:,0])[:,:,None]
+            first = np.where(min_first, mins, maxs)[:,:,1:]
+            second = np.where(min_first, maxs, mins)[:,:,1:]
+            points = np.concatenate(
+                (first[:,None], second[:,None]), axis=1).reshape(
+                    2*len(mins), 2*len(self.pairs))
+        tmp_name = self.cache_file + '~'
+        f = open(tmp_name, 'w')
+        np.savetxt(f, points, fmt='%.10g', delimiter='\t')
+        f.close()
+        replace_file(tmp_name, self.cache_file)
+
 class PyGnuplot(object):
     def __init__(self,
                  plotfile_name,
@@ -22,7 +311,12 @@ class PyGnuplot(object):
                  pause = 1.0,
                  savefig = True,
                  file_path = '',
-                 size = (640, 480)):
+                 size = (640, 480),
+                 pipe = False,
+                 png_interval = None,
+                 gnuplot = GNUPLOT,
+                 decimate = None,
+                 refresh = None):
         '''
         plotfile - string without extension, .gnu is added automatically
         pltofile_name.gnu - source file for gnuplot for creation of the plot
@@ -54,9 +348,38 @@ class PyGnuplot(object):
         numbers in case of x_ and y_columns and list of strings in case of
         markers. If only one string is used, each line in the graph is
         plotted that way - line or point
+
+        pipe - gnuplot is controlled through pipe and replots only changed
+        data (see module description), pause can be shorter than 1 s
+        png_interval - minimal time between saving of the figure in pipe
+        mode, 10*pause by default
+        gnuplot - gnuplot executable used in pipe mode (and by start_plot
+        on other systems than Windows)
+        decimate - number of buckets of min/max decimation (True - width
+        of the figure), see module description (decimated copies of the
+        data are updated by start_plot() thread or by calls of update())
+        refresh - RefreshScheduler (True - default one) for adaptive
+        refresh in pipe mode, pause is not used then
         '''
         self.file_path = file_path
         self.plotfile_name = plotfile_name
+        self.size = size
+        self.savefig = savefig
+        self.pipe = pipe
+        self.gnuplot = gnuplot
+        self.plots = plots
+        self.number_of_rows = number_of_rows
+        self.number_of_columns = number_of_columns
+        self.title = title
+        self.data_files = []
+        for plot in plots:
+            name = os.path.join(file_path, plot[0])
+            if not name in self.data_files: self.data_files.append(name)
+
+        if decimate is True: decimate = size[0]
+        self.caches = {}            # data file name: _DecimationCache
+        if decimate:
+            plots = [self._decimated_plot(plot, decimate) for plot in plots]
         
         if not len(plots) == number_of_rows*number_of_columns:
             raise RuntimeError(
@@ -67,7 +390,24 @@ class PyGnuplot(object):
         if file_path and (not os.path.exists(file_path)):
             os.makedirs(file_path)
 
-        if pause < 1.0: pause = 1.0
+        if pause < 1.0 and not pipe: pause = 1.0
+        self.pause = pause
+        if png_interval is None: png_interval = 10*pause
+        if refresh and not pipe:
+            raise RuntimeError('Adaptive refresh can be used only in pipe mode (pipe=True).')
+        if refresh is True: refresh = RefreshScheduler()
+        self.refresh = refresh
+        self.png_interval = png_interval
+
+        self._gnuplot = None
+        self._watcher = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._last_state = None
+        self._last_png = None
+        self._png_pending = False
+        self._last_arrays = None
+        self.render_time = 0.0      # time of the last update in pipe mode
             
         # create list of GNUPLOT commands
         # GNUPLOT documentaion:
@@ -92,16 +432,10 @@ class PyGnuplot(object):
                 ])
         
         multiplot_list.append('unset multiplot')
+        self.multiplot_list = multiplot_list
             
         if savefig:
-            line_list.extend([
-                'set term png size %i,%i' %(size[0], size[1]),
-                'set output "%s.png"'%(os.path.join(
-                    file_path, plotfile_name).replace('\\','\\\\')
-                                       )
-                ])
-            line_list.extend(multiplot_list)
-            line_list.append('unset output ') 
+            line_list.extend(self._png_lines())
         
         line_list.append('set term wxt size %i,%i' %(size[0], size[1]))
         line_list.extend(multiplot_list)
@@ -114,16 +448,235 @@ class PyGnuplot(object):
 
     def __repr__(self):
         return '<GNUPLOT data visualization class >'
+
+    def _decimated_plot(self, plot, buckets):
+        '''
+        Returns the plot tuple with the data file and columns replaced
+        by its decimation cache.
+        '''
+        name = os.path.join(self.file_path, plot[0])
+        if not name in self.caches:
+            self.caches[name] = _DecimationCache(name, buckets)
+        cache = self.caches[name]
+        if hasattr(plot[1], '__iter__'):
+            pairs = [cache.add_pair(x, y) for x, y in zip(plot[1], plot[2])]
+            x_columns = [2*p + 1 for p in pairs]
+            y_columns = [2*p + 2 for p in pairs]
+        else:
+            p = cache.add_pair(plot[1], plot[2])
+            x_columns, y_columns = 2*p + 1, 2*p + 2
+        return (plot[0] + '.dec', x_columns, y_columns) + tuple(plot[3:])
+
+    def update_caches(self, force=False):
+        '''
+        Updates the decimation caches of the data files which changed
+        since the last update. Returns True if some data file changed.
+        '''
+        state = self._data_state()
+        if state is None or (state == self._last_state and not force):
+            return False
+        self._last_state = state
+        for cache in self.caches.values():
+            cache.update()
+        return True
+
+    def png_file(self):
+        return os.path.join(self.file_path, self.plotfile_name+'.png')
+
+    def _png_lines(self, multiplot_list=None, term='png'):
+        '''
+        gnuplot commands which save the figure to plotfile_name.png
+        '''
+        return ([
+            'set term %s size %i,%i' %(term, self.size[0], self.size[1]),
+            'set output "%s.png"'%_gnuplot_path(
+                os.path.join(self.file_path, self.plotfile_name))
+            ] + (multiplot_list or self.multiplot_list) + ['unset output '])
     
-    def start_plot(self):
+    def start_plot(self, watch=True):
         '''
         start GNUPLOT as separate process and it will update plot automatically
         NOTE: you can use start_plot only when the source data file(s) for each
         plot is already created (datafilne_name.dat files).
+
+        In pipe mode, watch=False starts only gnuplot, plot is then updated
+        by calls of update(). Without pipe mode and with decimation, watch
+        starts thread which updates the decimated copies of the data files
+        (watch=False - by calls of update()).
         '''
-        os.system('START wgnuplot '+os.path.join(
-            self.file_path,self.plotfile_name+'.gnu')
-                  )
+        if self.caches and not self.pipe:
+            self.update_caches(force=True)
+            if watch: self._start_watcher()
+        if self.pipe:
+            if self._gnuplot is None:
+                self._gnuplot = _GnuplotProcess(
+                    self.gnuplot, capture=self.refresh is not None)
+                self._gnuplot.send([self._screen_term()])
+            self.update(force=True)
+            if watch: self._start_watcher()
+            return
+        script = os.path.join(self.file_path,self.plotfile_name+'.gnu')
+        if sys.platform.startswith('win'):
+            os.system('START wgnuplot '+script)
+        else:
+            subprocess.Popen([self.gnuplot, script])
+
+    def _start_watcher(self):
+        if self._watcher is None:
+            self._stop.clear()
+            self._watcher = threading.Thread(target=self._watch)
+            self._watcher.daemon = True
+            self._watcher.start()
+
+    def stop_plot(self):
+        '''
+        Stops the watching thread and gnuplot started in pipe mode.
+        The figure is saved if there are unsaved changes.
+        '''
+        if self._watcher is not None:
+            self._stop.set()
+            self._watcher.join()
+            self._watcher = None
+        if self._gnuplot is not None:
+            if self.savefig and self._png_pending and self._last_arrays is not None:
+                self._send_arrays(self._last_arrays, png=True)
+            elif self.savefig and self._png_pending:
+                self._send(self._png_lines())
+            self._gnuplot.close()
+            self._gnuplot = None
+
+    def _screen_term(self):
+        return 'set term wxt size %i,%i noraise' %(self.size[0], self.size[1])
+
+    def _send(self, line_list):
+        with self._lock:
+            self._gnuplot.send(line_list)
+            self._sync()
+
+    def _sync(self):
+        '''
+        With adaptive refresh waits until gnuplot draws the plot and
+        passes its messages to stderr.
+        '''
+        if self.refresh is not None:
+            for message in self._gnuplot.sync():
+                sys.stderr.write(message+'\n')
+
+    def _data_state(self):
+        '''
+        Returns list of (modification time, size) of the data files,
+        None if some file does not exist.
+        '''
+        state = []
+        for name in self.data_files:
+            try:
+                st = os.stat(name)
+            except OSError:
+                return None
+            state.append((st.st_mtime, st.st_size))
+        return state
+
+    def update(self, force=False):
+        '''
+        Pipe mode: replots the data if some data file changed since the last
+        update (or if force is True) and saves the figure if png_interval
+        elapsed since it was saved last time. Returns True if replotted.
+        Without pipe mode only decimation caches are updated (gnuplot
+        rereads them itself).
+        '''
+        if not self.pipe:
+            return self.update_caches(force)
+        if self._gnuplot is None:
+            raise RuntimeError('gnuplot is not running, use start_plot() in pipe mode')
+        replot = self.update_caches(force)
+        t0 = time.time()
+        if replot:
+            self._send(self.multiplot_list)
+            self._png_pending = self.savefig
+        now = time.time()
+        if self._png_pending and (
+                self._last_png is None or now - self._last_png >= self.png_interval):
+            self._send(self._png_lines() + [self._screen_term()])
+            self._last_png = now
+            self._png_pending = False
+        self.render_time = time.time() - t0
+        return replot
+
+    def plot_arrays(self, data):
+        '''
+        Pipe mode: plots arrays, data is a list with one item for each plot,
+        item is (x, y) where y is an array or a list of arrays (several
+        lines in the plot) and x is an array or a list of arrays of the
+        same length as y. The figure is saved if png_interval elapsed.
+        '''
+        if self._gnuplot is None:
+            raise RuntimeError('gnuplot is not running, use start_plot() in pipe mode')
+        if not len(data) == len(self.plots):
+            raise RuntimeError('data has to contain one item for each plot')
+        self._send_arrays(data)
+        self._last_arrays = data
+        self._png_pending = self.savefig
+        now = time.time()
+        if self._png_pending and (
+                self._last_png is None or now - self._last_png >= self.png_interval):
+            self._send_arrays(data, png=True)
+            self._last_png = now
+            self._png_pending = False
+
+    def _send_arrays(self, data, png=False):
+        '''
+        Sends multiplot with inline binary data of plot_arrays to gnuplot.
+        All commands and data are prepared before anything is sent, gnuplot
+        is not left in unfinished multiplot by invalid data.
+        '''
+        blocks = []
+        for plot, (x, y) in zip(self.plots, data):
+            x, y = _plot_lines(x, y)
+            markers = plot[6]
+            if isinstance(markers, str): markers = [markers]
+            markers = list(markers) + [markers[0]]*(len(y) - len(markers))
+            commands = []
+            records = []
+            for x_data, y_data, marker in zip(x, y, markers):
+                if not len(x_data) == len(y_data):
+                    raise RuntimeError("x and y arrays of a line have to be of the same length")
+                record = np.column_stack((x_data, y_data)).astype('<f8')
+                if not len(record):
+                    record = np.zeros((1, 2)) + np.nan
+                commands.append(
+                    "'-' binary record=(%i) format='%%float64%%float64' "
+                    "endian=little using 1:2 %s" %(
+                        len(record), self._add_marker_str(marker)))
+                records.append(record.tobytes())
+            blocks.append(([
+                'set xlabel "%s"' %plot[3],
+                'set ylabel "%s"' %plot[4],
+                'set title "%s"' %plot[5],
+                'plot ' + ', '.join(commands),
+                ], b''.join(records)))
+
+        with self._lock:
+            gp = self._gnuplot
+            if png:
+                gp.send(self._png_lines()[:2])
+            gp.send(self.multiplot_list[:2])
+            for commands, records in blocks:
+                gp.send(commands)
+                gp.send_data(records)
+            gp.send(['unset multiplot'])
+            if png:
+                gp.send(['unset output ', self._screen_term()])
+            self._sync()
+
+    def _watch(self):
+        interval = self.pause if self.refresh is None else self.refresh.interval
+        while not self._stop.wait(interval):
+            try:
+                replot = self.update()
+            except (IOError, OSError, RuntimeError):
+                break           # gnuplot was closed
+            if self.refresh is not None:
+                interval = self.refresh.record(replot, self.render_time)
             
     def _write_lines(self, line_list):
         for line in line_list:
@@ -148,7 +701,7 @@ class PyGnuplot(object):
         #this is case when there is only one set of data points to plot
         if (type(x_columns) == int) and (type(y_columns) == int) and (type(markers) == str):
             return 'plot "%s" using %i:%i %s'%(
-                    os.path.join(self.file_path, file_name).replace('\\','\\\\'),
+                    _gnuplot_path(os.path.join(self.file_path, file_name)),
                     x_columns,
                     y_columns,
                     self._add_marker_str(markers)
@@ -169,8 +722,8 @@ class PyGnuplot(object):
 
                 #multiset plot is created like this (example):
                 #plot "data.dat" using 1:2 with lines, "" using 1:3 with points, "" using 4:5 with points
-                ret = 'plot "%s" ' %os.path.join(
-                    self.file_path, file_name).replace('\\','\\\\')
+                ret = 'plot "%s" ' %_gnuplot_path(
+                    os.path.join(self.file_path, file_name))
 
                 i = 0
                 for x_c, y_c, mrkr in zip(x_columns, y_columns, marker_list):